@@ -34,7 +34,11 @@ class ControllerFrame(ttk.Frame):
         name_label = ttk.Label(self, text=f"Name: {controller.name}")
         ip_label = ttk.Label(self, text=f"Address: {controller.ip}")
         num_apps_label = ttk.Label(self, text=f"Num apps: {len(controller.inventory)}")
+        chunk_size_label = ttk.Label(self, text=f"Points per request: {controller.chunk_tuner.size}")
+        circuit_label = ttk.Label(self, text=f"Circuit: {controller.breaker.state.value}")
 
         name_label.pack()
         ip_label.pack()
         num_apps_label.pack()
+        chunk_size_label.pack()
+        circuit_label.pack()
@@ -11,6 +11,9 @@ import os
 from .ControllerInfo import ControllerInfo
 from .AzureStatus import AzureStatus
 
+# How long stopping waits for the mainloop to wind down
+SHUTDOWN_TIMEOUT_S = 30
+
 class GUI(ttk.Window):
     def __init__(self, loopfunc, version):
         super().__init__(themename="darkly")
@@ -52,6 +55,7 @@ class GUI(ttk.Window):
 
         self.loop = None
         self.thread = None
+        self.task = None
         self.loopfunc = loopfunc
 
         atexit.register(self.stop_async_thread)
@@ -59,17 +63,25 @@ class GUI(ttk.Window):
     def start_async_loop(self):
         self.loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.loop)
-        self.loop.create_task(self.loopfunc())
+        self.task = self.loop.create_task(self.loopfunc())
         self.loop.run_forever()
 
     def start_async_thread(self):
         self.thread = threading.Thread(target=self.start_async_loop)
         self.thread.start()
 
+    async def shutdown(self):
+        # Cancels the mainloop and lets it flush buffered messages and close sessions and the
+        # database before the loop stops
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            await asyncio.wait({self.task}, timeout=SHUTDOWN_TIMEOUT_S)
+        self.loop.stop()
+
     def stop_async_thread(self):
         if self.loop and self.loop.is_running():
             logging.info("Stopping program execution")
-            self.loop.stop()
+            asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop)
         if self.thread and self.thread.is_alive():
             self.thread.join()
 
@@ -2,6 +2,7 @@ import asyncio
 from azure.iot.device import ProvisioningDeviceClient
 from azure.iot.device.aio import IoTHubDeviceClient
 from azure.iot.device import Message
+from azure.iot.device.exceptions import CredentialError
 from azure.identity import CertificateCredential
 from azure.keyvault.secrets import SecretClient
 import base64
@@ -9,10 +10,21 @@ import hashlib
 import hmac
 import logging
 # import uuid
-from datetime import datetime, timezone
-import json
 import os
+import random
 import atexit
+from pathlib import Path
+from time import monotonic
+
+from .PayloadPacker import PayloadPacker, create_packer
+from .credential_cache import clear_credentials, load_credentials, save_credentials
+
+# Delay before provisioning again after a failure, doubling up to the maximum
+PROVISION_BACKOFF_S = 30
+PROVISION_MAX_BACKOFF_S = 900
+# Failed connects with the cached credentials before provisioning through Key Vault and DPS
+# again, the device may have been moved to another hub
+CACHED_CONNECT_ATTEMPTS = 3
 
 class IoTDevice:
     hostname: str = ""
@@ -20,9 +32,11 @@ class IoTDevice:
     connected: bool = False
 
     def __init__(self, tenant_id: str, client_id: str, device_id: str, scope_id: str,
-                 secret_name: str, keyvault: str, certificate: str | os.PathLike, sas_ttl: int):
+                 secret_name: str, keyvault: str, certificate: str | os.PathLike, sas_ttl: int, payload_format: int = 1,
+                 max_concurrent_sends: int = 4, credential_cache: str | os.PathLike = "iothub_credentials.bin"):
         logging.debug(f"Creating IoTDevice instance")
         self.device_id: str = device_id
+        self.registration_id: str = device_id
         self.scope_id: str = scope_id
         self.secret_name: str = secret_name
         keyvault_url: str = f"https://{keyvault}.vault.azure.net/"
@@ -30,99 +44,131 @@ class IoTDevice:
         self.secret_client: SecretClient = SecretClient(vault_url=keyvault_url, credential=self.credential)
         self.device_client: IoTHubDeviceClient | None = None
         self.sas_ttl: int = sas_ttl * 24 * 60 * 60
+        self.packer: PayloadPacker = create_packer(payload_format)
+        self.send_slots: asyncio.Semaphore = asyncio.Semaphore(max(1, max_concurrent_sends))
+        self.credential_cache: Path = Path(credential_cache)
+        self.provision_failures: int = 0
+        self.cached_connect_failures: int = 0
+        self.provision_retry_at: float = 0.0
         atexit.register(self.disconnect)
 
 
-    def provision_device(self):
+    async def provision_device(self):
+        # Connects with the cached hub and key when there are any, otherwise provisions through
+        # Key Vault and DPS. Their blocking calls run off the event loop, failures back off
+        if monotonic() < self.provision_retry_at:
+            return
         try:
+            credentials = await asyncio.to_thread(load_credentials, self.credential_cache)
+            if credentials is not None and credentials.get("registration_id") == self.registration_id and credentials.get("scope_id") == self.scope_id:
+                try:
+                    await self.connect(credentials["hostname"], credentials["device_id"], credentials["device_key"])
+                    self.provision_failures = 0
+                    self.cached_connect_failures = 0
+                    return
+                except CredentialError as e:
+                    logging.warning(f"Cached IoTHub credentials were rejected, provisioning again: {e}")
+                    await asyncio.to_thread(clear_credentials, self.credential_cache)
+                except Exception as e:
+                    self.cached_connect_failures += 1
+                    if self.cached_connect_failures < CACHED_CONNECT_ATTEMPTS:
+                        raise
+                    logging.warning(f"Could not connect with cached IoTHub credentials {self.cached_connect_failures} times, provisioning again: {e}")
+                    await asyncio.to_thread(clear_credentials, self.credential_cache)
+            self.cached_connect_failures = 0
+
             logging.debug(f"Trying to provision device")
-            group_key = self.secret_client.get_secret(self.secret_name).value
-            logging.debug(f"the dps enrollment key is: {group_key}")
+            secret = await asyncio.to_thread(self.secret_client.get_secret, self.secret_name)
 
-            keybytes = base64.b64decode(group_key)
-            hmac_sha256 = hmac.new(keybytes, self.device_id.encode(), hashlib.sha256)
-            self.device_key = base64.b64encode(hmac_sha256.digest()).decode()
+            keybytes = base64.b64decode(secret.value)
+            hmac_sha256 = hmac.new(keybytes, self.registration_id.encode(), hashlib.sha256)
+            device_key = base64.b64encode(hmac_sha256.digest()).decode()
 
             provisioning_device_client = ProvisioningDeviceClient.create_from_symmetric_key(
                 provisioning_host="global.azure-devices-provisioning.net",
-                registration_id=self.device_id,
+                registration_id=self.registration_id,
                 id_scope=self.scope_id,
-                symmetric_key=self.device_key,
+                symmetric_key=device_key,
             )
 
-            registration_result = provisioning_device_client.register()
-            self.hostname = registration_result.registration_state.assigned_hub
-            self.device_id = registration_result.registration_state.device_id
-            logging.info(f"Provisioned device {self.device_id}")
-
-            self.device_client = IoTHubDeviceClient.create_from_symmetric_key(
-                symmetric_key=self.device_key,
-                hostname=self.hostname,
-                device_id=self.device_id,
-                sastoken_ttl=self.sas_ttl
-            )
-            self.device_client.connect()
-            logging.info(f"Device {self.device_id} is ready to receive messages in IoTHub")
+            registration_result = await asyncio.to_thread(provisioning_device_client.register)
+            hostname = registration_result.registration_state.assigned_hub
+            device_id = registration_result.registration_state.device_id
+            logging.info(f"Provisioned device {device_id}")
+
+            await self.connect(hostname, device_id, device_key)
+            await asyncio.to_thread(save_credentials, self.credential_cache, {
+                "registration_id": self.registration_id,
+                "scope_id": self.scope_id,
+                "hostname": hostname,
+                "device_id": device_id,
+                "device_key": device_key,
+            })
+            self.provision_failures = 0
 
-            self.connected = True
-    
         except Exception as e:
             self.connected = False
-            logging.debug(f"Not able to connect to IoTHub. Error: {e}")
-
-
-    async def send_messages(self, messages: list[tuple[str]]) -> bool:
-        maximized_payloads = []
-
-        message_struct = {
-            "timestamp": datetime.now(timezone.utc).isoformat(),
-            "payload": [],
-        }
-
-        for i, msg in enumerate(messages):
-
-            filtered_message = {"timestamp": msg[0], "ip": msg[1], "response": msg[2], "method": msg[3]}
-            message_struct["payload"].append(filtered_message)
-            string_payload = json.dumps(message_struct)
-            message = Message(string_payload)
-            size = message.get_size()
-
-            if size >= 256_000:
-                # Remove the last message that caused overflow
-                message_struct["payload"].pop()
-                payload_str = json.dumps(message_struct)
-                maximized_payloads.append(Message(payload_str))
-
-                # Start new message_struct with the current message
-                message_struct = {
-                    "timestamp": datetime.now(timezone.utc).isoformat(),
-                    "payload": [filtered_message],
-                }
-
-        # Handle remaining messages
-        if message_struct["payload"]:
-            payload_str = json.dumps(message_struct)
-            maximized_payloads.append(Message(payload_str))
-
-        maximized_payloads = [msg for msg in maximized_payloads if msg.get_size() <= 256_000]
-
-        async def send_message(message):
-            logging.debug(f"Sending message to IoTHub at {self.device_id}")
-            await self.device_client.send_message(message)
-
-        if self.connected:
+            delay = min(PROVISION_MAX_BACKOFF_S, PROVISION_BACKOFF_S * 2 ** self.provision_failures) * random.uniform(0.5, 1.5)
+            self.provision_failures += 1
+            self.provision_retry_at = monotonic() + delay
+            logging.debug(f"Not able to connect to IoTHub, retrying in {delay:.0f} seconds. Error: {e}")
+
+    async def connect(self, hostname: str, device_id: str, device_key: str):
+        if self.device_client is not None:
+            # The client of a dropped connection is replaced rather than reused
             try:
-                tasks = [send_message(msg) for msg in maximized_payloads]
-                await asyncio.gather(*tasks)
-                logging.debug("Sucessfully sent messages to IoTHub")
-                return True
+                await self.device_client.shutdown()
             except Exception as e:
-                self.connected = False
-                logging.error(f"IoTHub was connected but this send failed {e}")
-                return False
-        else:
+                logging.debug(f"Could not shut down the previous IoTHub client: {e}")
+            self.device_client = None
+
+        self.hostname = hostname
+        self.device_id = device_id
+        self.device_key = device_key
+        self.device_client = IoTHubDeviceClient.create_from_symmetric_key(
+            symmetric_key=device_key,
+            hostname=hostname,
+            device_id=device_id,
+            sastoken_ttl=self.sas_ttl
+        )
+        await self.device_client.connect()
+        logging.info(f"Device {self.device_id} is ready to receive messages in IoTHub")
+        self.connected = True
+
+    async def send_messages(self, messages: list[tuple]) -> tuple[list[int], list[int]]:
+        # messages are outbox rows: (id, ts in epoch milliseconds, ip, response, method).
+        # Returns the ids of the rows that were delivered and of the rows that were not
+        payloads = self.packer.pack(messages)
+        if not self.connected:
             logging.warning(f"Cannot send telemetry to {self.device_id}. Device is not connected")
-            return False
+            return [], [message[0] for message in messages]
+
+        failed = False
+
+        async def send_payload(payload) -> bool:
+            nonlocal failed
+            async with self.send_slots:
+                # Once one send failed the rest wait for the retry instead of piling on
+                if failed:
+                    return False
+                message = Message(payload.body, content_encoding=self.packer.content_encoding, content_type=self.packer.content_type)
+                try:
+                    logging.debug(f"Sending {len(payload.ids)} messages to IoTHub at {self.device_id}")
+                    await self.device_client.send_message(message)
+                    return True
+                except Exception as e:
+                    failed = True
+                    logging.error(f"IoTHub was connected but this send failed {e}")
+                    return False
+
+        results = await asyncio.gather(*[send_payload(payload) for payload in payloads])
+        delivered = [row_id for payload, sent in zip(payloads, results) if sent for row_id in payload.ids]
+        undelivered = [row_id for payload, sent in zip(payloads, results) if not sent for row_id in payload.ids]
+        if failed:
+            self.connected = False
+        else:
+            logging.debug("Sucessfully sent messages to IoTHub")
+        return delivered, undelivered
 
     def disconnect(self):
         logging.info(f"Disconnecting from IoTHub")
@@ -0,0 +1,193 @@
+import json
+import logging
+import zlib
+from datetime import datetime, timezone
+
+# IoT Hub rejects messages over 256 KB, get_size also counts the message properties
+MAX_MESSAGE_BYTES = 256_000
+PROPERTY_RESERVE_BYTES = 1_000
+
+# Version 1 is a plain JSON list of rows, version 2 gzip-compressed dictionary-coded rows
+PAYLOAD_FORMATS = (1, 2)
+
+# One IoT Hub message body and the outbox ids of the rows in it
+class Payload:
+    __slots__ = ("ids", "body")
+
+    def __init__(self, ids: list[int], body: str | bytes):
+        self.ids: list[int] = ids
+        self.body: str | bytes = body
+
+# Packs outbox rows into as few messages as fit under the size limit in a single pass. Each row
+# is encoded once and its size added to a running total, stored responses are already JSON
+# and are spliced in as they are
+class PayloadPacker:
+    payload_format: int = 1
+    content_encoding: str | None = None
+    content_type: str | None = None
+
+    def __init__(self, max_bytes: int = MAX_MESSAGE_BYTES - PROPERTY_RESERVE_BYTES):
+        self.max_bytes: int = max_bytes
+
+    def pack(self, rows: list[tuple]) -> list[Payload]:
+        # rows are outbox rows: (id, ts in epoch milliseconds, ip, response, method)
+        payloads = []
+        ids = []
+        fragments = []
+        head, tail = self.envelope()
+        size = len(head) + len(tail)
+        for row in rows:
+            fragment = self.encode_row(row)
+            fragment_size = len(fragment.encode())
+            if len(head) + fragment_size + len(tail) > self.max_bytes:
+                fragment = self.oversized_row(row, fragment_size)
+                fragment_size = len(fragment.encode())
+            separator = 2 if fragments else 0
+            if fragments and size + separator + fragment_size > self.max_bytes:
+                payloads.append(Payload(ids, head + ", ".join(fragments) + tail))
+                ids = []
+                fragments = []
+                head, tail = self.envelope()
+                size = len(head) + len(tail)
+                separator = 0
+            ids.append(row[0])
+            fragments.append(fragment)
+            size += separator + fragment_size
+
+        if fragments:
+            payloads.append(Payload(ids, head + ", ".join(fragments) + tail))
+        return payloads
+
+    def envelope(self) -> tuple[str, str]:
+        return f'{{"timestamp": "{datetime.now(timezone.utc).isoformat()}", "payload": [', "]}"
+
+    def encode_row(self, row: tuple) -> str:
+        _, ts, ip, response, method = row
+        return (
+            f'{{"timestamp": "{datetime.fromtimestamp(ts / 1000, timezone.utc).isoformat()}", '
+            f'"ip": {json.dumps(ip)}, "response": {response}, "method": {json.dumps(method)}}}'
+        )
+
+    def oversized_row(self, row: tuple, size: int) -> str:
+        # A row that cannot fit any message is sent as a marker so the gap is visible upstream
+        row_id, ts, ip, _, method = row
+        logging.error(f"Message {row_id} ({method} from {ip}) is {size} bytes, over the IoT Hub limit of {self.max_bytes}. Sending it without its response")
+        return self.encode_row((row_id, ts, ip, json.dumps({"error": f"Response of {size} bytes exceeds the message size limit"}), method))
+
+# Format 2: {"v": 2, "timestamp": ..., "rows": [[ts, ip index, method index, response], ...],
+# "ips": [...], "methods": [...]} compressed with gzip. Timestamps are epoch milliseconds and
+# ips and methods are written once per message in the dictionaries after the rows, which are
+# only complete once the last row is in
+class GzipPayloadPacker(PayloadPacker):
+    payload_format: int = 2
+    content_encoding: str | None = "gzip"
+    content_type: str | None = "application/json"
+
+    # Upper bound of what the dictionaries and the end of the gzip stream add to a message
+    TRAILER_RESERVE_BYTES = 64
+
+    def __init__(self, max_bytes: int = MAX_MESSAGE_BYTES - PROPERTY_RESERVE_BYTES, level: int = 6):
+        super().__init__(max_bytes)
+        self.level: int = level
+
+    def pack(self, rows: list[tuple]) -> list[Payload]:
+        payloads = []
+        message = None
+        for row in rows:
+            if message is None:
+                message = GzipMessage(self.level)
+            if message.add(row, self.max_bytes - self.TRAILER_RESERVE_BYTES):
+                continue
+            if message.ids:
+                payloads.append(message.finish())
+                message = GzipMessage(self.level)
+                if message.add(row, self.max_bytes - self.TRAILER_RESERVE_BYTES):
+                    continue
+            # Does not fit even in a message of its own
+            size = len(self.encode_row(row).encode())
+            marker = (row[0], row[1], row[2], json.dumps({"error": f"Response of {size} bytes exceeds the message size limit"}), row[4])
+            logging.error(f"Message {row[0]} ({row[4]} from {row[2]}) does not fit an IoT Hub message even compressed. Sending it without its response")
+            message.add(marker, self.max_bytes - self.TRAILER_RESERVE_BYTES)
+
+        if message is not None and message.ids:
+            payloads.append(message.finish())
+        return payloads
+
+# One format 2 message being compressed. The compressed size is only known exactly after a
+# sync flush, so rows are counted at their uncompressed size (an upper bound) until the next
+# row might not fit, and the stream is flushed only then
+class GzipMessage:
+    def __init__(self, level: int):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.chunks: list[bytes] = []
+        self.compressed: int = 0
+        self.pending: int = 0
+        self.ids: list[int] = []
+        self.ips: dict[str, int] = {}
+        self.methods: dict[str, int] = {}
+        self.dictionary_bytes: int = 0
+        timestamp = datetime.now(timezone.utc).isoformat()
+        self.write(f'{{"v": 2, "timestamp": "{timestamp}", "rows": ['.encode())
+
+    def write(self, data: bytes) -> None:
+        chunk = self.compressor.compress(data)
+        self.chunks.append(chunk)
+        self.compressed += len(chunk)
+        self.pending += len(data)
+
+    def sync(self) -> None:
+        chunk = self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.chunks.append(chunk)
+        self.compressed += len(chunk)
+        self.pending = 0
+
+    def try_write(self, data: bytes, max_bytes: int) -> bool:
+        # Compresses the row on a copy of the stream and keeps it only if the result fits
+        trial = self.compressor.copy()
+        chunk = trial.compress(data) + trial.flush(zlib.Z_SYNC_FLUSH)
+        if self.compressed + len(chunk) > max_bytes:
+            return False
+        self.compressor = trial
+        self.chunks.append(chunk)
+        self.compressed += len(chunk)
+        return True
+
+    def add(self, row: tuple, max_bytes: int) -> bool:
+        # Adds the row unless it could push the finished message over max_bytes
+        row_id, ts, ip, response, method = row
+        new_ip = ip not in self.ips
+        new_method = method not in self.methods
+        ip_index = self.ips.get(ip, len(self.ips))
+        method_index = self.methods.get(method, len(self.methods))
+        data = f'{", " if self.ids else ""}[{ts}, {ip_index}, {method_index}, {response}]'.encode()
+        dictionary_bytes = self.dictionary_bytes + (len(json.dumps(ip)) + 2 if new_ip else 0) + (len(json.dumps(method)) + 2 if new_method else 0)
+
+        if self.compressed + self.pending + len(data) + dictionary_bytes > max_bytes:
+            if self.pending > 0:
+                self.sync()
+            if self.compressed + len(data) + dictionary_bytes <= max_bytes:
+                self.write(data)
+            elif not self.try_write(data, max_bytes - dictionary_bytes):
+                return False
+        else:
+            self.write(data)
+
+        self.ids.append(row_id)
+        if new_ip:
+            self.ips[ip] = ip_index
+        if new_method:
+            self.methods[method] = method_index
+        self.dictionary_bytes = dictionary_bytes
+        return True
+
+    def finish(self) -> Payload:
+        self.write(f'], "ips": {json.dumps(list(self.ips))}, "methods": {json.dumps(list(self.methods))}}}'.encode())
+        self.chunks.append(self.compressor.flush())
+        return Payload(self.ids, b"".join(self.chunks))
+
+def create_packer(payload_format: int) -> PayloadPacker:
+    if payload_format == 2:
+        return GzipPayloadPacker()
+    if payload_format != 1:
+        logging.warning(f"Unknown payload_format {payload_format}, using 1")
+    return PayloadPacker()
@@ -7,7 +7,8 @@ def create_iot_device(settings_azure):
         add_cert(settings_azure["certificate_name"])
         iot_device = IoTDevice(
             **{k: v for k, v in settings_azure.items() if k not in ["certificate_name"]},
-            certificate=Path(__file__).parent.parent.parent/"data"/"certificate_python.pfx"
+            certificate=Path(__file__).parent.parent.parent/"data"/"certificate_python.pfx",
+            credential_cache=Path(__file__).parent.parent.parent/"data"/"iothub_credentials.bin",
         )
     finally:
         remove_cert()
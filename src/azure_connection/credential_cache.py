@@ -0,0 +1,66 @@
+import json
+import logging
+import os
+from pathlib import Path
+
+# The assigned hub and derived device key are kept so a restart can connect without going
+# through Key Vault and DPS. On Windows the file is encrypted for the current user with DPAPI,
+# elsewhere it is only readable by its owner
+if os.name == "nt":
+    import ctypes
+    from ctypes import wintypes
+
+    CRYPTPROTECT_UI_FORBIDDEN = 0x01
+
+    class DATA_BLOB(ctypes.Structure):
+        _fields_ = [("cbData", wintypes.DWORD), ("pbData", ctypes.POINTER(ctypes.c_char))]
+
+    def _dpapi(function, data: bytes) -> bytes:
+        buffer = ctypes.create_string_buffer(data, len(data))
+        blob_in = DATA_BLOB(len(data), ctypes.cast(buffer, ctypes.POINTER(ctypes.c_char)))
+        blob_out = DATA_BLOB()
+        if not function(ctypes.byref(blob_in), None, None, None, None, CRYPTPROTECT_UI_FORBIDDEN, ctypes.byref(blob_out)):
+            raise ctypes.WinError()
+        try:
+            return ctypes.string_at(blob_out.pbData, blob_out.cbData)
+        finally:
+            ctypes.windll.kernel32.LocalFree(blob_out.pbData)
+
+    def protect(data: bytes) -> bytes:
+        return _dpapi(ctypes.windll.crypt32.CryptProtectData, data)
+
+    def unprotect(data: bytes) -> bytes:
+        return _dpapi(ctypes.windll.crypt32.CryptUnprotectData, data)
+
+else:
+    def protect(data: bytes) -> bytes:
+        return data
+
+    def unprotect(data: bytes) -> bytes:
+        return data
+
+def load_credentials(path: Path) -> dict | None:
+    if not path.is_file():
+        return None
+    try:
+        return json.loads(unprotect(path.read_bytes()))
+    except Exception as e:
+        logging.warning(f"Could not read cached IoTHub credentials, provisioning again: {e}")
+        clear_credentials(path)
+        return None
+
+def save_credentials(path: Path, credentials: dict) -> None:
+    data = protect(json.dumps(credentials).encode())
+    temporary = path.with_suffix(".tmp")
+    temporary.unlink(missing_ok=True)
+    # Created owner-only from the start, the key is never readable by anyone else
+    fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o600)
+    with os.fdopen(fd, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+    logging.debug(f"Cached IoTHub credentials in {path}")
+
+def clear_credentials(path: Path) -> None:
+    path.unlink(missing_ok=True)
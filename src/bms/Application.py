@@ -13,6 +13,6 @@ class Application:
     commissionable: int = field(default=0, repr=False)
     device: bool = field(default=False, repr=False)
     devicetype: str = field(default="", repr=False)
-    properties: list[str] = field(default_factory=list, repr=False)
+    properties: tuple[str, ...] = field(default=(), repr=False)
     DevAddr: str = field(default="", repr=False)
     Route: str = field(default="", repr=False)
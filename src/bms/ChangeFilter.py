@@ -0,0 +1,40 @@
+import logging
+from time import monotonic
+from .PointRecord import PointRecord
+
+# Drops point values that did not change since they were last saved. Numeric values count as
+# changed when they move more than the deadband of their point or apptype, anything else when
+# it differs at all. Every point is saved again at least once per heartbeat interval
+class ChangeFilter:
+    def __init__(self, deadbands: dict[str, float], heartbeat: float):
+        self.deadbands: dict[str, float] = deadbands
+        self.heartbeat: float = heartbeat
+        # (controller, iid, point) -> (last saved value, quality, time it was saved)
+        self.last_values: dict[tuple[str, str, str], tuple[object, int, float]] = {}
+
+    def deadband_for(self, apptype: str, point: str) -> float:
+        deadband = self.deadbands.get(f"{apptype}:{point}")
+        if deadband is None:
+            deadband = self.deadbands.get(apptype, 0)
+        return deadband
+
+    def changed(self, record: PointRecord, apptype: str, now: float) -> bool:
+        key = (record.controller, record.iid, record.point)
+        last = self.last_values.get(key)
+        if last is not None and now - last[2] < self.heartbeat and record.quality == last[1]:
+            last_value = last[0]
+            if isinstance(record.value, (int, float)) and isinstance(last_value, (int, float)):
+                unchanged = abs(record.value - last_value) <= self.deadband_for(apptype, record.point)
+            else:
+                unchanged = record.value == last_value
+            if unchanged:
+                return False
+        self.last_values[key] = (record.value, record.quality, now)
+        return True
+
+    def filter(self, records: list[PointRecord], apptypes: dict[str, str]) -> list[PointRecord]:
+        # apptypes maps the iid of every polled application to its apptype
+        now = monotonic()
+        changed = [record for record in records if self.changed(record, apptypes.get(record.iid, ""), now)]
+        logging.debug(f"Kept {len(changed)} of {len(records)} point values")
+        return changed
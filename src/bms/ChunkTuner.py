@@ -0,0 +1,61 @@
+import json
+import logging
+from pathlib import Path
+
+CHUNK_SIZES_PATH = Path(__file__).parent.parent.parent / "data" / "chunk_sizes.json"
+
+# Learns how many points a controller can answer in one GetPointValues request.
+# The size grows slowly while requests are fast and small, shrinks on slow
+# responses and is halved on errors, always within [min_size, max_size]
+class ChunkTuner:
+    step: int = 10
+    grow_after: int = 3
+    max_response_bytes: int = 64_000
+
+    def __init__(self, name: str, min_size: int, max_size: int, target_latency: float, initial: int = 50):
+        self.name: str = name
+        self.min_size: int = max(1, min_size)
+        self.max_size: int = max(self.min_size, max_size)
+        self.target_latency: float = target_latency
+        self.size: int = self.clamp(initial)
+        self.changed: bool = False
+        self._streak: int = 0
+
+    def clamp(self, size: int) -> int:
+        return min(self.max_size, max(self.min_size, int(size)))
+
+    def observe(self, latency: float, response_bytes: int, ok: bool) -> None:
+        if not ok:
+            self._streak = 0
+            self._set(self.size // 2)
+        elif latency > self.target_latency:
+            self._streak = 0
+            self._set(self.size - self.step)
+        elif response_bytes < self.max_response_bytes:
+            self._streak += 1
+            if self._streak >= self.grow_after:
+                self._streak = 0
+                self._set(self.size + self.step)
+
+    def _set(self, size: int) -> None:
+        size = self.clamp(size)
+        if size != self.size:
+            self.size = size
+            self.changed = True
+
+def load_chunk_sizes() -> dict[str, int]:
+    try:
+        with open(CHUNK_SIZES_PATH) as f:
+            return {ip: int(size) for ip, size in json.load(f).items()}
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logging.warning(f"Could not load learned chunk sizes, starting from defaults: {e}")
+        return {}
+
+def save_chunk_sizes(sizes: dict[str, int]) -> None:
+    try:
+        with open(CHUNK_SIZES_PATH, "w+") as f:
+            json.dump(sizes, f, indent=2)
+    except Exception as e:
+        logging.warning(f"Could not save learned chunk sizes: {e}")
@@ -0,0 +1,68 @@
+import logging
+import random
+from enum import Enum
+from time import monotonic
+
+class CircuitState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+# Stops talking to a controller after failure_threshold requests in a row have failed.
+# While open nothing is sent until the backoff has passed, then one probe decides whether
+# the circuit closes again or reopens with twice the backoff (plus jitter, up to max_backoff)
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int, base_backoff: float, max_backoff: float):
+        self.name: str = name
+        self.failure_threshold: int = max(1, failure_threshold)
+        self.base_backoff: float = base_backoff
+        self.max_backoff: float = max_backoff
+        self.state: CircuitState = CircuitState.CLOSED
+        self.failures: int = 0
+        self.opened: int = 0
+        self.retry_at: float = 0.0
+
+    @property
+    def closed(self) -> bool:
+        return self.state is CircuitState.CLOSED
+
+    def probe_due(self) -> bool:
+        # Moves an open circuit to half-open once its backoff has passed
+        if self.state is CircuitState.OPEN and monotonic() >= self.retry_at:
+            self.state = CircuitState.HALF_OPEN
+            logging.info(f"Circuit for {self.name} is half-open, probing the controller")
+            return True
+        return False
+
+    def probe_finished(self) -> None:
+        # A probe that ended without recording an outcome counts as failed, otherwise the
+        # circuit would stay half-open and never be probed again
+        if self.state is CircuitState.HALF_OPEN:
+            logging.info(f"Probe of {self.name} ended without an answer")
+            self._open()
+
+    def record_success(self) -> None:
+        if self.state is not CircuitState.CLOSED:
+            logging.info(f"Circuit for {self.name} closed, controller is reachable again")
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self.opened = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state is CircuitState.OPEN:
+            # Requests that were already in flight when the circuit opened
+            return
+        if self.state is CircuitState.HALF_OPEN or self.failures >= self.failure_threshold:
+            self._open()
+
+    def backoff(self, attempt: int) -> float:
+        delay = min(self.max_backoff, self.base_backoff * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.5)
+
+    def _open(self) -> None:
+        delay = self.backoff(self.opened)
+        self.opened += 1
+        self.state = CircuitState.OPEN
+        self.retry_at = monotonic() + delay
+        logging.warning(f"Circuit for {self.name} opened after {self.failures} failures, skipping it for {delay:.0f} seconds")
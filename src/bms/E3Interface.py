@@ -1,140 +1,280 @@
 import asyncio
 import aiohttp
-import urllib.parse
-import json
 import logging
-from pathlib import Path
+from time import perf_counter, time
 from .Application import Application
+from .RequestPacer import RequestPacer
+from .ChunkTuner import ChunkTuner
+from .request_planner import plan_point_requests
+from .RequestTemplate import RequestTemplate, SID_MARKER, encode_sid
+from .PointLibrary import get_point_library
+from .CircuitBreaker import CircuitBreaker
+from .SingleFlight import SingleFlight
+from .PointRecord import PointRecord, parse_point_values
 
 class E3Interface():
-    current_request_id: int = 1
-    sid: str = ""
-    inventory: list[Application] = []
-    
-
-    def __init__(self, name: str, ip: str, timeout: int, retries: int, retry_delay: int, request_delay: int):
+    def __init__(self, name: str, ip: str, timeout: int, retries: int, retry_delay: int, request_delay: int,
+                 pool_size: int = 2, keepalive: int = 30, max_in_flight: int = 2, max_request_rate: float = 20,
+                 target_latency: int = 1_000, min_points: int = 10, max_points: int = 150, chunk_size: int = 50,
+                 failure_threshold: int = 3, max_backoff: int = 900, inventory_ttl: int = 300, sid_ttl: int = 60):
         self.name: str = name
         self.ip: str = ip
+        self.current_request_id: int = 1
+        self.sid: str = ""
+        self.inventory: list[Application] = []
+        self.inventory_data: list[dict] = []
         self.endpoint: str = f"http://{ip}/cgi-bin/mgw.cgi"
         self.timeout: int = timeout
         self.retries = retries
         self.retry_delay = retry_delay / 1000
         self.request_delay = request_delay / 1000
+        self.pool_size: int = pool_size
+        self.keepalive: int = keepalive
+        self.session: aiohttp.ClientSession | None = None
+        self.pacer: RequestPacer = RequestPacer(
+            name=name,
+            max_in_flight=min(max_in_flight, pool_size),
+            initial_delay=self.request_delay,
+            max_rate=max_request_rate,
+            target_latency=target_latency / 1000,
+        )
+        self.chunk_tuner: ChunkTuner = ChunkTuner(
+            name=name,
+            min_size=min_points,
+            max_size=max_points,
+            target_latency=target_latency / 1000,
+            initial=chunk_size,
+        )
+        self.breaker: CircuitBreaker = CircuitBreaker(
+            name=name,
+            failure_threshold=failure_threshold,
+            base_backoff=self.retry_delay,
+            max_backoff=max_backoff,
+        )
+        self.flights: SingleFlight = SingleFlight()
+        self.inventory_ttl: int = inventory_ttl
+        self.sid_ttl: int = sid_ttl
+
+        # Request urls are encoded once and reused until the inventory changes
+        self.encoded_sid: str = encode_sid(self.sid)
+        self.method_templates: dict[tuple[str, str], RequestTemplate] = {}
+        self.point_templates: dict[tuple, tuple[int, list[RequestTemplate]]] = {}
+
+    async def open(self) -> None:
+        # One keep-alive session per controller, the embedded web server cannot handle many sockets
+        if self.session is not None and not self.session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.pool_size,
+            limit_per_host=self.pool_size,
+            keepalive_timeout=self.keepalive,
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        logging.debug(f"Opened http session for {self.name} at {self.ip}")
 
-        with open(Path(__file__).parent.parent.parent/"conf"/"ptrs.json") as f:
-            self.ptr_library: dict[str, list[str]] = json.load(f)
+    async def close(self) -> None:
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+            logging.debug(f"Closed http session for {self.name} at {self.ip}")
+        self.session = None
 
     def update_request_id(self) -> None:
         self.current_request_id = 1 if self.current_request_id >= 999 else self.current_request_id + 1
 
-    async def set_sid(self) -> bool:
-        sid = await self.get_method("GetSessionID")
+    async def available(self) -> bool:
+        # False while the circuit is open, a due probe refreshes the SessionID and closes it on success
+        if self.breaker.closed:
+            return True
+        if not self.breaker.probe_due():
+            return False
+        try:
+            await self.set_sid(probe=True)
+        finally:
+            self.breaker.probe_finished()
+        return self.breaker.closed
+
+    async def set_sid(self, probe: bool = False) -> bool:
+        if probe:
+            # A probe always goes to the controller on its own, joining a request that is already
+            # in flight would leave its outcome to a request that gives up while the circuit is
+            # not closed. A fresh SID replaces the cached one
+            self.flights.invalidate("GetSessionID")
+            sid = await self.get_method("GetSessionID", probe=True)
+        else:
+            sid = await self.flights.do(
+                "GetSessionID",
+                lambda: self.get_method("GetSessionID"),
+                ttl=self.sid_ttl,
+                cacheable=self.has_result,
+            )
         try:
             new_sid = sid[0]["result"]["sid"]
             logging.debug(f"Got new SID for {self.name}: {new_sid}")
-            self.sid = new_sid
+            if new_sid != self.sid:
+                self.sid = new_sid
+                self.encoded_sid = encode_sid(new_sid)
             return True
         except:
             return False
 
     async def get_system_inventory(self):
-        return await self.post_method("GetSystemInventory")
+        return await self.flights.do(
+            "GetSystemInventory",
+            lambda: self.post_method("GetSystemInventory"),
+            ttl=self.inventory_ttl,
+            cacheable=self.has_result,
+        )
+
+    @staticmethod
+    def has_result(response) -> bool:
+        try:
+            return "result" in response[0]
+        except (IndexError, KeyError, TypeError):
+            return False
 
     async def set_system_inventory(self) -> bool:
         inventory = await self.get_system_inventory()
         try:
-            new_inventory_data = inventory[0]["result"]["aps"]
-            self.inventory = []
-            for app in new_inventory_data:
-                apptype = app["apptype"]
-                try:
-                    properties = self.ptr_library[apptype]
-                    application = Application(**app, properties=properties)
-                    self.inventory.append(application)
-                except:
-                    logging.warning(f"Unknown apptype: {apptype} in {self.name} at {self.ip}")
+            self.inventory_data = inventory[0]["result"]["aps"]
+            self.apply_point_library()
             logging.info(f"Updated {self.name}'s inventory")
             return True
         except:
             return False
 
+    def apply_point_library(self) -> None:
+        # Resolve the last inventory against the shared point library, also called after it is reloaded
+        library = get_point_library()
+        new_inventory = []
+        for app in self.inventory_data:
+            apptype = app["apptype"]
+            properties = library.get(apptype)
+            if properties is None:
+                logging.warning(f"Unknown apptype: {apptype} in {self.name} at {self.ip}")
+                continue
+            try:
+                new_inventory.append(Application(**app, properties=properties))
+            except TypeError as e:
+                logging.warning(f"Unexpected application data for {apptype} in {self.name} at {self.ip}: {e}")
+        if new_inventory != self.inventory:
+            self.inventory = new_inventory
+            self.point_templates = {}
+
     async def get_alarms(self):
         return await self.post_method("GetAlarms")
 
-    async def get_point_values(self, app):
-
-        # Func to chunk through property lists
-        def param_chunker(app, size):
-            params_list = []
-            chunks = (app.properties[pos:pos + size] for pos in range(0, len(app.properties), size))
-            for chunk in chunks:
-                params = {
-                    "sid": self.sid,
-                    "points": []
-                }
-                for prop in chunk:
-                    params["points"].append({"ptr": f"{app.iid}:{prop}"})
-                params_list.append(params)
-
-            return params_list
+    async def get_point_records(self, apps: list[Application]) -> tuple[list[PointRecord], list]:
+        # Point values as records plus the responses of requests that failed, requests that were
+        # never sent because the circuit opened during the poll are in neither
+        ts = time()
+        responses = await self.request_point_values(apps)
+        return parse_point_values(self.ip, responses, ts)
 
-        requests_queue = []
-        requests = param_chunker(app, 50)
-        requests_queue.extend(requests)
-
-        return await self.post_method("GetPointValues", requests_queue)
+    async def request_point_values(self, apps: list[Application]) -> list:
+        key = tuple((app.iid, app.properties) for app in apps)
+        size, templates = self.point_templates.get(key, (0, []))
+        if size != self.chunk_tuner.size:
+            size = self.chunk_tuner.size
+            templates = [
+                RequestTemplate(self.endpoint, "GetPointValues", {"sid": SID_MARKER, "points": [{"ptr": ptr} for ptr in batch]})
+                for batch in plan_point_requests(apps, size)
+            ]
+            if len(self.point_templates) >= 64:
+                self.point_templates = {}
+            self.point_templates[key] = (size, templates)
+        return await self.send_templates(templates, "POST", observer=self.chunk_tuner.observe)
 
     async def touch_session(self):
         await self.post_method("TouchSession")
 
-    async def http_requests(self, urls, method):
+    async def http_requests(self, urls, method, observer=None, probe=False):
+        # observer(latency, response_bytes, ok) hears how the controller coped with the size of a
+        # request: replies, slow or not, and errors from a controller that answers. Retries and
+        # connection failures say nothing about the size and are not passed on
+        # a probe is sent once even though the circuit is not closed
+        def observe(attempt, latency, response_bytes, ok):
+            if observer is not None and attempt == 0:
+                observer(latency, response_bytes, ok)
+
         async def http_request(session, url, method):
             logging.debug(f"Sending {method}: {url} to {self.endpoint}")
             retries: int = 0
-            while retries < self.retries:
-                try:
-                    async with session.request(method, url, timeout=self.timeout) as response:
-                        response.raise_for_status()
-                        data = await response.json()
+            attempts = 1 if probe else self.retries
+            while retries < attempts:
+                async with self.pacer:
+                    if not probe and not self.breaker.closed:
+                        logging.debug(f"Circuit for {self.name} is {self.breaker.state.value}, not sending {method}")
+                        return [{"method": method, "ip": self.ip, "error": "Could not complete request", "skipped": True}]
+                    start = perf_counter()
+                    reachable = self.breaker.failures == 0
+                    try:
+                        async with session.request(method, url) as response:
+                            response.raise_for_status()
+                            response_bytes = len(await response.read())
+                            data = await response.json()
+                        latency = perf_counter() - start
+                        self.pacer.success(latency)
+                        self.breaker.record_success()
                         logging.debug(f"Response received from {self.ip}")
                         try:
                             data["result"]["ip"] = self.ip
                         except:
+                            observe(retries, latency, response_bytes, False)
                             return [{"method": method, "ip": self.ip, "error": "Could not complete request"}]
+                        observe(retries, latency, response_bytes, True)
                         return data
-                except aiohttp.ClientError as e:
-                    logging.warning(f"ClientError at {self.name} at {self.ip}: {e}")
-                except asyncio.TimeoutError:
-                    logging.warning(f"Request to {self.name} at {self.ip} timed out after {self.timeout} seconds.")
+                    except aiohttp.ClientResponseError as e:
+                        # The controller answered, but not with a usable reply
+                        self.pacer.failure("http error")
+                        self.breaker.record_failure()
+                        observe(retries, perf_counter() - start, 0, False)
+                        logging.warning(f"ClientError at {self.name} at {self.ip}: {e}")
+                    except aiohttp.ClientError as e:
+                        self.pacer.failure("http error")
+                        self.breaker.record_failure()
+                        logging.warning(f"ClientError at {self.name} at {self.ip}: {e}")
+                    except asyncio.TimeoutError:
+                        self.pacer.failure("timeout")
+                        self.breaker.record_failure()
+                        # Only a slow reply while the controller was answering, an unreachable one times out too
+                        if reachable:
+                            observe(retries, perf_counter() - start, 0, True)
+                        logging.warning(f"Request to {self.name} at {self.ip} timed out after {self.timeout} seconds.")
 
-                logging.info(f"Waiting {self.retry_delay} seconds before retrying request")
                 retries += 1
-                await asyncio.sleep(self.retry_delay)
-            logging.error("Could not complete request")
+                if retries < attempts:
+                    delay = self.breaker.backoff(retries - 1)
+                    logging.info(f"Waiting {delay:.1f} seconds before retrying request")
+                    await asyncio.sleep(delay)
+            logging.error(f"Could not complete request to {self.name} at {self.ip}")
             return [{"method": method, "ip": self.ip, "error": "Could not complete request"}]
 
-        async with aiohttp.ClientSession() as session:
-            results = []
-            for url in urls:
-                results.append(await http_request(session, url, method))
-                await asyncio.sleep(self.request_delay)
-            return results
-
-    async def get_method(self, method: str):
-        query = {"jsonrpc": "2.0", "method": method, "id": f"{self.current_request_id}"}
-        m_string = f"?m={urllib.parse.quote(json.dumps(query))}"
-        self.update_request_id()
-        return await self.http_requests([f"{self.endpoint}{m_string}"], "GET")
-
-    async def post_method(self, method, params=None):
-        if self.sid == "":
+        if self.session is None or self.session.closed:
+            await self.open()
+        # The pacer bounds how many of these are actually in flight
+        return await asyncio.gather(*[http_request(self.session, url, method) for url in urls])
+
+    def method_template(self, method: str, http_method: str) -> RequestTemplate:
+        key = (method, http_method)
+        if key not in self.method_templates:
+            params = {"sid": SID_MARKER} if http_method == "POST" else None
+            self.method_templates[key] = RequestTemplate(self.endpoint, method, params)
+        return self.method_templates[key]
+
+    async def send_templates(self, templates: list[RequestTemplate], http_method: str, observer=None, probe=False):
+        if self.sid == "" and any(template.needs_sid for template in templates):
             _ = await self.set_sid()
-        if params is None:
-            params = [{"sid": self.sid}]
         queue = []
-        for param in params:
-            query = {"jsonrpc": "2.0", "method": method, "params": param, "id": f"{self.current_request_id}"}
-            m_string = f"?m={urllib.parse.quote(json.dumps(query))}"
-            queue.append(f"{self.endpoint}{m_string}")
+        for template in templates:
+            queue.append(template.render(self.encoded_sid, self.current_request_id))
             self.update_request_id()
-        return await self.http_requests(queue, "POST")
+        return await self.http_requests(queue, http_method, observer, probe)
+
+    async def get_method(self, method: str, probe: bool = False):
+        return await self.send_templates([self.method_template(method, "GET")], "GET", probe=probe)
+
+    async def post_method(self, method):
+        return await self.send_templates([self.method_template(method, "POST")], "POST")
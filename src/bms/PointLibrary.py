@@ -0,0 +1,58 @@
+import json
+import logging
+import os
+from pathlib import Path
+from types import MappingProxyType
+from typing import Mapping
+
+PTRS_PATH = Path(__file__).parent.parent.parent / "conf" / "ptrs.json"
+
+# Read-only view of ptrs.json indexed by apptype. One instance is shared by every
+# controller, applications reference its point tuples instead of copying them
+class PointLibrary:
+    __slots__ = ("_points", "path", "mtime")
+
+    def __init__(self, points: Mapping[str, tuple[str, ...]], path: Path, mtime: float):
+        self._points: Mapping[str, tuple[str, ...]] = MappingProxyType(dict(points))
+        self.path: Path = path
+        self.mtime: float = mtime
+
+    @classmethod
+    def load(cls, path: Path = PTRS_PATH) -> "PointLibrary":
+        mtime = os.stat(path).st_mtime
+        with open(path) as f:
+            raw: dict[str, list[str]] = json.load(f)
+        points = {apptype: tuple(dict.fromkeys(ptrs)) for apptype, ptrs in raw.items()}
+        logging.debug(f"Loaded {sum(len(ptrs) for ptrs in points.values())} points for {len(points)} apptypes from {path}")
+        return cls(points, path, mtime)
+
+    def get(self, apptype: str) -> tuple[str, ...] | None:
+        return self._points.get(apptype)
+
+    def __contains__(self, apptype: str) -> bool:
+        return apptype in self._points
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+_library: PointLibrary | None = None
+
+def get_point_library() -> PointLibrary:
+    global _library
+    if _library is None:
+        _library = PointLibrary.load()
+    return _library
+
+def reload_point_library() -> bool:
+    # Swap in a new library if ptrs.json changed on disk, keep the current one if it cannot be read
+    global _library
+    current = get_point_library()
+    try:
+        if os.stat(current.path).st_mtime == current.mtime:
+            return False
+        _library = PointLibrary.load(current.path)
+    except Exception as e:
+        logging.warning(f"Could not reload {current.path}, keeping the current point library: {e}")
+        return False
+    logging.info(f"Reloaded point library from {current.path}")
+    return True
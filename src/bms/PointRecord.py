@@ -0,0 +1,66 @@
+import json
+import math
+
+QUALITY_GOOD = 0
+QUALITY_MISSING = 1
+
+# One point value read from a controller, parsed once from the GetPointValues response
+class PointRecord:
+    __slots__ = ("controller", "iid", "point", "value", "quality", "ts")
+
+    def __init__(self, controller: str, iid: str, point: str, value, quality: int, ts: float):
+        self.controller: str = controller
+        self.iid: str = iid
+        self.point: str = point
+        self.value: int | float | str | None = value
+        self.quality: int = quality
+        self.ts: float = ts
+
+    def __repr__(self) -> str:
+        return f"PointRecord({self.controller}, {self.iid}:{self.point}={self.value!r}, quality={self.quality}, ts={self.ts})"
+
+def typed_value(value):
+    if not isinstance(value, str):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        number = float(value)
+    except ValueError:
+        return value
+    return number if math.isfinite(number) else value
+
+def parse_point_values(controller: str, responses: list, ts: float) -> tuple[list[PointRecord], list]:
+    # Returns the records of every successful response and the failed responses as they are.
+    # Responses marked skipped stand for requests that were never sent and are left out
+    records: list[PointRecord] = []
+    errors = []
+    for response in responses:
+        if skipped(response):
+            continue
+        try:
+            points = response["result"]["points"]
+        except (KeyError, TypeError):
+            errors.append(response)
+            continue
+        for point in points:
+            iid, _, name = str(point.get("ptr", "")).partition(":")
+            if "val" in point:
+                records.append(PointRecord(controller, iid, name, typed_value(point["val"]), QUALITY_GOOD, ts))
+            else:
+                records.append(PointRecord(controller, iid, name, None, QUALITY_MISSING, ts))
+    return records, errors
+
+def skipped(response) -> bool:
+    # Requests that were not sent come back like failed ones, as a list holding the marked error
+    errors = response if isinstance(response, list) else [response]
+    return bool(errors) and all(isinstance(error, dict) and error.get("skipped") for error in errors)
+
+def encode_point_records(records: list[PointRecord]) -> str:
+    # Controller and timestamp are stored once per row, each record is [iid, point, value, quality]
+    return json.dumps([[r.iid, r.point, r.value, r.quality] for r in records], separators=(",", ":"))
+
+def decode_point_records(controller: str, ts: float, encoded: str) -> list[PointRecord]:
+    return [PointRecord(controller, iid, point, value, quality, ts) for iid, point, value, quality in json.loads(encoded)]
@@ -0,0 +1,52 @@
+import asyncio
+import logging
+from time import perf_counter
+
+# Paces the requests sent to one controller. At most max_in_flight requests run at once,
+# the request rate goes up additively while responses are fast and is halved on slow
+# responses, timeouts or http errors (AIMD)
+class RequestPacer:
+    def __init__(self, name: str, max_in_flight: int, initial_delay: float, max_rate: float,
+                 target_latency: float, min_rate: float = 0.2, rate_step: float = 1.0):
+        self.name: str = name
+        self.max_in_flight: int = max(1, max_in_flight)
+        self.max_rate: float = max_rate
+        self.min_rate: float = min(min_rate, max_rate)
+        self.rate_step: float = rate_step
+        self.target_latency: float = target_latency
+        self.rate: float = max_rate if initial_delay <= 0 else min(max(1 / initial_delay, self.min_rate), max_rate)
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        self._next_send: float = 0.0
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self._semaphore.acquire()
+        try:
+            async with self._lock:
+                wait = self._next_send - perf_counter()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                self._next_send = perf_counter() + 1 / self.rate
+        except BaseException:
+            self._semaphore.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._semaphore.release()
+        return False
+
+    def success(self, latency: float) -> None:
+        if latency > self.target_latency:
+            self._decrease(f"slow response ({latency:.2f}s)")
+        else:
+            self.rate = min(self.max_rate, self.rate + self.rate_step)
+
+    def failure(self, reason: str) -> None:
+        self._decrease(reason)
+
+    def _decrease(self, reason: str) -> None:
+        new_rate = max(self.min_rate, self.rate / 2)
+        if new_rate != self.rate:
+            logging.debug(f"Backing off requests to {self.name} to {new_rate:.2f}/s after {reason}")
+        self.rate = new_rate
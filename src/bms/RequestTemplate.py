@@ -0,0 +1,37 @@
+import json
+import re
+import urllib.parse
+
+SID_MARKER = "__E3_SID__"
+ID_MARKER = "__E3_ID__"
+_MARKERS = re.compile(f"({SID_MARKER}|{ID_MARKER})")
+
+def encode_sid(sid: str) -> str:
+    # The sid sits inside a json string, so only its json escaped and url quoted content is spliced in
+    return urllib.parse.quote(json.dumps(sid)[1:-1])
+
+# A JSON-RPC request url encoded once. Only the sid and the request id change between
+# cycles, they are spliced in between the pre-encoded parts when the request is sent
+class RequestTemplate:
+    __slots__ = ("parts", "fields")
+
+    def __init__(self, endpoint: str, method: str, params: dict | None = None):
+        query = {"jsonrpc": "2.0", "method": method}
+        if params is not None:
+            query["params"] = params
+        query["id"] = ID_MARKER
+        encoded = f"{endpoint}?m={urllib.parse.quote(json.dumps(query))}"
+        pieces = _MARKERS.split(encoded)
+        self.parts: tuple[str, ...] = tuple(pieces[0::2])
+        self.fields: tuple[str, ...] = tuple(pieces[1::2])
+
+    @property
+    def needs_sid(self) -> bool:
+        return SID_MARKER in self.fields
+
+    def render(self, encoded_sid: str, request_id: int) -> str:
+        values = [encoded_sid if field == SID_MARKER else str(request_id) for field in self.fields]
+        url = self.parts[0]
+        for value, part in zip(values, self.parts[1:]):
+            url += value + part
+        return url
@@ -0,0 +1,35 @@
+import asyncio
+from time import monotonic
+from typing import Any, Awaitable, Callable
+
+# Concurrent callers asking for the same key share one in-flight request. Results that pass
+# the cacheable check are kept for ttl seconds and returned without asking the controller again
+class SingleFlight:
+    def __init__(self):
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._cache: dict[str, tuple[float, Any]] = {}
+
+    async def do(self, key: str, func: Callable[[], Awaitable], ttl: float = 0.0,
+                 cacheable: Callable[[Any], bool] = lambda _: True) -> Any:
+        cached = self._cache.get(key)
+        if cached is not None and monotonic() < cached[0]:
+            return cached[1]
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+
+        # A cancelled caller must not cancel the request the others are waiting on
+        result = await asyncio.shield(task)
+        if ttl > 0 and cacheable(result):
+            self._cache[key] = (monotonic() + ttl, result)
+        return result
+
+    def _forget(self, key: str, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    def invalidate(self, key: str) -> None:
+        self._cache.pop(key, None)
@@ -1 +1,5 @@
 from .E3Interface import E3Interface
+from .ChunkTuner import load_chunk_sizes, save_chunk_sizes
+from .PointLibrary import PointLibrary, get_point_library, reload_point_library
+from .ChangeFilter import ChangeFilter
+from .PointRecord import PointRecord, encode_point_records, decode_point_records
@@ -0,0 +1,7 @@
+from .Application import Application
+
+def plan_point_requests(apps: list[Application], max_points: int) -> list[list[str]]:
+    # Pack the pointers of all applications into as few GetPointValues requests as possible,
+    # an application with more points than fit in one request spills over into the next
+    pointers = [f"{app.iid}:{prop}" for app in apps for prop in app.properties]
+    return [pointers[pos:pos + max_points] for pos in range(0, len(pointers), max_points)]
@@ -0,0 +1,229 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import zlib
+from array import array
+from bisect import bisect_right
+from pathlib import Path
+
+# A record is its body length and the crc32 of its body, then the body: id, ts, payload kind,
+# ip and method lengths, ip, method and payload
+RECORD_HEADER = struct.Struct("<II")
+RECORD_FIELDS = struct.Struct("<QqBHH")
+KIND_TEXT = 0
+KIND_BLOB = 1
+
+SEGMENT_SUFFIX = ".seg"
+CURSOR_FILE = "cursor.json"
+
+# One segment file, named after the first id it holds. The ids and file offsets of its records
+# are kept in memory so any record can be read without scanning
+class Segment:
+    __slots__ = ("path", "ids", "offsets", "size")
+
+    def __init__(self, path: Path):
+        self.path: Path = path
+        self.ids: array = array("Q")
+        self.offsets: array = array("Q")
+        self.size: int = 0
+
+    @property
+    def last_id(self) -> int:
+        return self.ids[-1] if self.ids else 0
+
+def encode_record(row_id: int, ts: int, ip: str, response: str | bytes, method: str) -> bytes:
+    kind = KIND_BLOB if isinstance(response, bytes) else KIND_TEXT
+    payload = response if kind == KIND_BLOB else response.encode()
+    ip_bytes = ip.encode()
+    method_bytes = method.encode()
+    body = RECORD_FIELDS.pack(row_id, ts, kind, len(ip_bytes), len(method_bytes)) + ip_bytes + method_bytes + payload
+    return RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+def decode_record(buffer, offset: int) -> tuple:
+    length, _ = RECORD_HEADER.unpack_from(buffer, offset)
+    start = offset + RECORD_HEADER.size
+    row_id, ts, kind, ip_length, method_length = RECORD_FIELDS.unpack_from(buffer, start)
+    position = start + RECORD_FIELDS.size
+    ip = bytes(buffer[position:position + ip_length]).decode()
+    position += ip_length
+    method = bytes(buffer[position:position + method_length]).decode()
+    payload = bytes(buffer[position + method_length:start + length])
+    return row_id, ts, ip, payload if kind == KIND_BLOB else payload.decode(), method
+
+# Append-only log of messages in size-rotated segment files. Everything up to acked_through
+# (plus the ids in acked) has been delivered, the cursor file records both and is replaced
+# atomically. Segments are only ever deleted whole, once all of their records are delivered.
+# Ids start after id_base. Not thread safe, SegmentLogStorage runs one operation at a time
+class SegmentLog:
+    def __init__(self, directory: Path, segment_bytes: int, id_base: int = 0):
+        self.directory: Path = directory
+        self.segment_bytes: int = segment_bytes
+        self.segments: list[Segment] = []
+        self.next_id: int = id_base + 1
+        self.acked_through: int = id_base
+        self.acked: set[int] = set()
+        self.writer = None
+
+    def load(self) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        cursor_path = self.directory / CURSOR_FILE
+        if cursor_path.exists():
+            try:
+                cursor = json.loads(cursor_path.read_text())
+                self.acked_through = cursor["acked_through"]
+                self.acked = set(cursor["acked"])
+            except (ValueError, KeyError, TypeError) as e:
+                logging.error(f"Could not read the outbox cursor, resending every stored message: {e}")
+
+        self.segments = []
+        for path in sorted(self.directory.glob(f"*{SEGMENT_SUFFIX}")):
+            segment = self.scan_segment(path)
+            if segment.ids:
+                self.segments.append(segment)
+            else:
+                path.unlink()
+        self.next_id = max([self.acked_through] + [segment.last_id for segment in self.segments]) + 1
+        self.drop_delivered_segments()
+        logging.debug(f"Loaded {len(self.segments)} outbox segments from {self.directory}, next id {self.next_id}")
+
+    def scan_segment(self, path: Path) -> Segment:
+        # Indexes every record and cuts the file at the first one that is torn or corrupt
+        segment = Segment(path)
+        size = path.stat().st_size
+        if size == 0:
+            return segment
+        with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            offset = 0
+            while offset + RECORD_HEADER.size <= size:
+                length, crc = RECORD_HEADER.unpack_from(buffer, offset)
+                end = offset + RECORD_HEADER.size + length
+                if length < RECORD_FIELDS.size or end > size or zlib.crc32(buffer[offset + RECORD_HEADER.size:end]) != crc:
+                    break
+                segment.ids.append(RECORD_FIELDS.unpack_from(buffer, offset + RECORD_HEADER.size)[0])
+                segment.offsets.append(offset)
+                offset = end
+        if offset < size:
+            logging.warning(f"Discarding {size - offset} bytes after the last intact record of {path.name}")
+            os.truncate(path, offset)
+        segment.size = offset
+        return segment
+
+    def append(self, rows: list[tuple[int, str, str | bytes, str]]) -> None:
+        # Flushed to the OS after every call, so messages survive the app crashing. Segments are
+        # synced to disk when they are rotated or closed, like SQLite's synchronous NORMAL
+        for ts, ip, response, method in rows:
+            record = encode_record(self.next_id, ts, ip, response, method)
+            segment = self.segments[-1] if self.segments and self.writer is not None else None
+            if segment is None or (segment.size > 0 and segment.size + len(record) > self.segment_bytes):
+                segment = self.rotate()
+            self.writer.write(record)
+            segment.ids.append(self.next_id)
+            segment.offsets.append(segment.size)
+            segment.size += len(record)
+            self.next_id += 1
+        if self.writer is not None:
+            self.writer.flush()
+
+    def rotate(self) -> Segment:
+        self.close_writer()
+        segment = Segment(self.directory / f"{self.next_id:020d}{SEGMENT_SUFFIX}")
+        self.writer = open(segment.path, "ab")
+        self.segments.append(segment)
+        return segment
+
+    def close_writer(self) -> None:
+        if self.writer is None:
+            return
+        self.writer.flush()
+        os.fsync(self.writer.fileno())
+        self.writer.close()
+        self.writer = None
+
+    def close(self) -> None:
+        self.close_writer()
+        self.save_cursor()
+
+    def read(self, limit: int, skip: set[int], end_id: int | None = None) -> list[tuple]:
+        # The oldest undelivered records not in skip (and before end_id), as (id, ts, ip, response, method)
+        rows = []
+        for segment in self.segments:
+            if len(rows) >= limit or (end_id is not None and segment.ids[0] >= end_id):
+                break
+            if segment.last_id <= self.acked_through:
+                continue
+            with open(segment.path, "rb") as file, mmap.mmap(file.fileno(), segment.size, access=mmap.ACCESS_READ) as buffer:
+                for index in range(bisect_right(segment.ids, self.acked_through), len(segment.ids)):
+                    row_id = segment.ids[index]
+                    if end_id is not None and row_id >= end_id:
+                        break
+                    if row_id in self.acked or row_id in skip:
+                        continue
+                    rows.append(decode_record(buffer, segment.offsets[index]))
+                    if len(rows) >= limit:
+                        break
+        return rows
+
+    def ack(self, ids: list[int]) -> None:
+        self.acked.update(row_id for row_id in ids if row_id > self.acked_through)
+        # Moves acked_through over every delivered record that directly follows it
+        for segment in self.segments:
+            if segment.last_id <= self.acked_through:
+                continue
+            for index in range(bisect_right(segment.ids, self.acked_through), len(segment.ids)):
+                row_id = segment.ids[index]
+                if row_id not in self.acked:
+                    break
+                self.acked.discard(row_id)
+                self.acked_through = row_id
+            else:
+                continue
+            break
+        self.drop_delivered_segments()
+        self.save_cursor()
+
+    def skip_to(self, keep_from: int) -> None:
+        # Treats every record before keep_from as delivered
+        self.acked_through = max(self.acked_through, keep_from - 1)
+        self.acked = {row_id for row_id in self.acked if row_id > self.acked_through}
+        self.drop_delivered_segments()
+        self.save_cursor()
+
+    def drop_delivered_segments(self) -> None:
+        keep = []
+        for segment in self.segments:
+            # The segment being written to stays until it is rotated
+            active = self.writer is not None and segment is self.segments[-1]
+            if segment.last_id <= self.acked_through and not active:
+                segment.path.unlink(missing_ok=True)
+                logging.debug(f"Deleted delivered outbox segment {segment.path.name}")
+            else:
+                keep.append(segment)
+        self.segments = keep
+
+    def save_cursor(self) -> None:
+        path = self.directory / CURSOR_FILE
+        temporary = path.with_suffix(".tmp")
+        with open(temporary, "w") as file:
+            json.dump({"acked_through": self.acked_through, "acked": sorted(self.acked)}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, path)
+
+    def pending(self) -> tuple[int, int, int] | None:
+        # First and last undelivered id and the bytes from the first one to the end of the log
+        used_bytes = 0
+        first_id = None
+        for segment in self.segments:
+            index = bisect_right(segment.ids, self.acked_through)
+            if index == len(segment.ids):
+                continue
+            if first_id is None:
+                first_id = segment.ids[index]
+                used_bytes += segment.size - segment.offsets[index]
+            else:
+                used_bytes += segment.size
+        if first_id is None:
+            return None
+        return first_id, self.next_id - 1, used_bytes
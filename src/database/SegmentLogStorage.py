@@ -0,0 +1,84 @@
+import asyncio
+import logging
+from pathlib import Path
+
+from .SegmentLog import SegmentLog
+from .Storage import LANE_ID_SHIFT, LANE_POINTS, LANE_ROLLUP, LANES, Storage
+
+# Keeps the offline messages in append-only segment logs instead of a SQLite table, one log per
+# lane. Every message is written once, delivered messages only move the cursor and leases
+# live in memory
+class SegmentLogStorage(Storage):
+    def __init__(self, directory: Path, segment_bytes: int):
+        self.directory: Path = directory
+        # The point values lane keeps the top directory, so logs written before lanes existed carry on
+        self.logs: dict[int, SegmentLog] = {
+            lane: SegmentLog(directory if lane == LANE_POINTS else directory / f"lane{lane}", segment_bytes, lane << LANE_ID_SHIFT)
+            for lane in LANES
+        }
+        self.lock: asyncio.Lock = asyncio.Lock()
+        # batch id -> ids leased to it
+        self.leases: dict[int, set[int]] = {}
+
+    async def run(self, func, *args):
+        # File operations run one at a time, off the event loop
+        async with self.lock:
+            return await asyncio.to_thread(func, *args)
+
+    async def open(self) -> None:
+        for log in self.logs.values():
+            await self.run(log.load)
+        logging.debug(f"Opened outbox segment logs at {self.directory}")
+
+    async def close(self) -> None:
+        for log in self.logs.values():
+            await self.run(log.close)
+        logging.debug(f"Closed outbox segment logs at {self.directory}")
+
+    async def append(self, rows: list[tuple[int, str, str | bytes, str]], lane: int = LANE_POINTS) -> None:
+        await self.run(self.logs[lane].append, rows)
+
+    async def claim(self, batch_id: int, limit: int) -> list[tuple]:
+        leased = set().union(*self.leases.values())
+        rows = []
+        for lane in LANES:
+            if len(rows) >= limit:
+                break
+            rows += await self.run(self.logs[lane].read, limit - len(rows), leased)
+        if rows:
+            self.leases[batch_id] = {row[0] for row in rows}
+        return rows
+
+    async def ack(self, ids: list[int]) -> None:
+        for batch_id in list(self.leases):
+            self.leases[batch_id].difference_update(ids)
+            if not self.leases[batch_id]:
+                del self.leases[batch_id]
+        for lane, log in self.logs.items():
+            lane_ids = [row_id for row_id in ids if row_id >> LANE_ID_SHIFT == lane]
+            if lane_ids:
+                await self.run(log.ack, lane_ids)
+
+    async def release(self, batch_id: int) -> None:
+        self.leases.pop(batch_id, None)
+
+    async def release_all(self) -> None:
+        self.leases.clear()
+
+    async def clear(self) -> None:
+        self.leases.clear()
+        for log in self.logs.values():
+            await self.run(log.skip_to, log.next_id)
+
+    async def pending(self) -> dict[int, tuple[int, int, int] | None]:
+        return {lane: await self.run(log.pending) for lane, log in self.logs.items()}
+
+    async def read_before(self, lane: int, keep_from: int) -> list[tuple]:
+        log = self.logs[lane]
+        return await self.run(log.read, keep_from - log.acked_through, set(), keep_from)
+
+    async def drop_before(self, lane: int, keep_from: int, rollups: list[tuple[int, str, str | bytes, str]] | None = None) -> None:
+        # Space comes back once a cursor has passed a whole segment
+        if rollups:
+            await self.run(self.logs[LANE_ROLLUP].append, rollups)
+        await self.run(self.logs[lane].skip_to, keep_from)
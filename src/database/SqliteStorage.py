@@ -0,0 +1,163 @@
+import aiosqlite
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+from .Storage import LANE_ID_SHIFT, LANE_POINTS, LANE_ROLLUP, LANES, Storage
+from .migrations import migrate
+
+# Applied to the connection when it is opened
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -8_000,
+    "mmap_size": 64_000_000,
+    "temp_store": "MEMORY",
+    "busy_timeout": 5_000,
+}
+
+# The messages table of a SQLite database, the batch id of a leased row is kept in processed
+class SqliteStorage(Storage):
+    def __init__(self, path: Path):
+        self.path: Path = path
+        self.db: aiosqlite.Connection | None = None
+        self.lock: asyncio.Lock = asyncio.Lock()
+
+    async def open(self) -> None:
+        # One long-lived connection (and worker thread) for the whole app, created on the running loop
+        if self.db is not None:
+            return
+        db = await aiosqlite.connect(self.path)
+        for pragma, value in SQLITE_PRAGMAS.items():
+            await db.execute(f"PRAGMA {pragma} = {value}")
+        await migrate(db)
+        self.db = db
+        logging.debug(f"Opened database at {self.path}")
+
+    async def close(self) -> None:
+        if self.db is None:
+            return
+        async with self.lock:
+            await self.db.close()
+            self.db = None
+        logging.debug(f"Closed database at {self.path}")
+
+    @asynccontextmanager
+    async def connection(self):
+        # Operations take turns on the shared connection so their transactions never interleave
+        if self.db is None:
+            await self.open()
+        async with self.lock:
+            try:
+                yield self.db
+            except BaseException:
+                await self.db.rollback()
+                raise
+
+    async def append(self, rows: list[tuple[int, str, str | bytes, str]], lane: int = LANE_POINTS) -> None:
+        async with self.connection() as db:
+            await self.insert(db, rows, lane)
+            await db.commit()
+
+    async def insert(self, db: aiosqlite.Connection, rows: list[tuple[int, str, str | bytes, str]], lane: int) -> None:
+        # Each lane numbers its rows in its own id range, see LANE_ID_SHIFT
+        last_id = await self.fetch_value(db, "SELECT max(id) FROM messages WHERE id > ? AND id < ?", lane_range(lane))
+        first_id = (last_id if last_id is not None else lane << LANE_ID_SHIFT) + 1
+        await db.executemany(
+            "INSERT INTO messages (id, ts, ip, response, method, lane) VALUES (?, ?, ?, ?, ?, ?)",
+            [(first_id + i, *row, lane) for i, row in enumerate(rows)],
+        )
+
+    async def claim(self, batch_id: int, limit: int) -> list[tuple]:
+        # One index range per lane, in priority order
+        rows = []
+        async with self.connection() as db:
+            for lane in LANES:
+                if len(rows) >= limit:
+                    break
+                await db.execute(
+                    """
+                    UPDATE messages SET processed = ?
+                    WHERE id IN (SELECT id FROM messages WHERE processed = 0 AND lane = ? ORDER BY id LIMIT ?)
+                    """,
+                    (batch_id, lane, limit - len(rows)),
+                )
+                async with db.execute(
+                    "SELECT id, ts, ip, response, method FROM messages WHERE processed = ? AND lane = ? ORDER BY id",
+                    (batch_id, lane),
+                ) as cursor:
+                    rows += await cursor.fetchall()
+            await db.commit()
+        return rows
+
+    async def ack(self, ids: list[int]) -> None:
+        async with self.connection() as db:
+            await db.executemany("DELETE FROM messages WHERE id = ?", [(row_id,) for row_id in ids])
+            await db.commit()
+
+    async def release(self, batch_id: int) -> None:
+        async with self.connection() as db:
+            await db.execute("UPDATE messages SET processed = 0 WHERE processed = ?", (batch_id,))
+            await db.commit()
+
+    async def release_all(self) -> None:
+        async with self.connection() as db:
+            await db.execute("UPDATE messages SET processed = 0 WHERE processed > 0")
+            await db.commit()
+
+    async def clear(self) -> None:
+        async with self.connection() as db:
+            await db.execute("DELETE FROM messages")
+            await db.commit()
+        await self.release_free_pages()
+
+    async def fetch_value(self, db: aiosqlite.Connection, query: str, parameters: tuple = ()):
+        async with db.execute(query, parameters) as cursor:
+            row = await cursor.fetchone()
+        return row[0]
+
+    async def pending(self) -> dict[int, tuple[int, int, int] | None]:
+        # The ends of each lane's id range are two primary key lookups, the database size is
+        # shared out between the lanes by their id spans
+        spans = {}
+        async with self.connection() as db:
+            for lane in LANES:
+                first_id = await self.fetch_value(db, "SELECT min(id) FROM messages WHERE id > ? AND id < ?", lane_range(lane))
+                if first_id is not None:
+                    spans[lane] = (first_id, await self.fetch_value(db, "SELECT max(id) FROM messages WHERE id > ? AND id < ?", lane_range(lane)))
+            if not spans:
+                return {lane: None for lane in LANES}
+            page_size = await self.fetch_value(db, "PRAGMA page_size")
+            used_bytes = (await self.fetch_value(db, "PRAGMA page_count") - await self.fetch_value(db, "PRAGMA freelist_count")) * page_size
+        total_rows = sum(last_id - first_id + 1 for first_id, last_id in spans.values())
+        return {
+            lane: (*spans[lane], used_bytes * (spans[lane][1] - spans[lane][0] + 1) // total_rows) if lane in spans else None
+            for lane in LANES
+        }
+
+    async def read_before(self, lane: int, keep_from: int) -> list[tuple]:
+        async with self.connection() as db:
+            async with db.execute(
+                "SELECT id, ts, ip, response, method FROM messages WHERE id > ? AND id < ? ORDER BY id",
+                (lane << LANE_ID_SHIFT, keep_from),
+            ) as cursor:
+                return await cursor.fetchall()
+
+    async def drop_before(self, lane: int, keep_from: int, rollups: list[tuple[int, str, str | bytes, str]] | None = None) -> None:
+        async with self.connection() as db:
+            if rollups:
+                await self.insert(db, rollups, LANE_ROLLUP)
+            await db.execute("DELETE FROM messages WHERE id > ? AND id < ?", (lane << LANE_ID_SHIFT, keep_from))
+            await db.commit()
+        await self.release_free_pages()
+
+    async def release_free_pages(self, max_pages: int = 2_000) -> None:
+        # Gives a bounded number of free pages back to the filesystem, deleted rows leave them behind
+        async with self.connection() as db:
+            # The pragma frees one page per step, executescript steps it to the end
+            await db.executescript(f"PRAGMA incremental_vacuum({max_pages});")
+
+def lane_range(lane: int) -> tuple[int, int]:
+    # Bounds of the ids of lane, both exclusive
+    return lane << LANE_ID_SHIFT, (lane + 1) << LANE_ID_SHIFT
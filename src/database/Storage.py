@@ -0,0 +1,119 @@
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from typing import Callable
+
+# Rows are claimed lane by lane in LANES order: alarms, inventories, point values (and anything
+# else) and last the rollups made from trimmed point values. The numbers are only ids, lanes 0
+# and 1 keep the meaning they had before alarms and inventories got lanes of their own
+LANE_POINTS = 0
+LANE_ROLLUP = 1
+LANE_ALARMS = 2
+LANE_INVENTORY = 3
+LANES = (LANE_ALARMS, LANE_INVENTORY, LANE_POINTS, LANE_ROLLUP)
+LANE_NAMES = {"alarms": LANE_ALARMS, "inventory": LANE_INVENTORY, "points": LANE_POINTS, "rollups": LANE_ROLLUP}
+
+# Ids of a lane start at lane << LANE_ID_SHIFT, so an id alone tells which lane it is in and the
+# id span of a lane bounds how many rows it holds
+LANE_ID_SHIFT = 48
+
+# When a backlog has to be trimmed, bulk point values go first and alarms last
+TRIM_ORDER = (LANE_POINTS, LANE_INVENTORY, LANE_ROLLUP, LANE_ALARMS)
+
+# Turns rows that are about to be trimmed into rollup rows, (id, ts, ip, response, method) in
+# and (ts, ip, response, method) out
+Compactor = Callable[[list[tuple]], list[tuple[int, str, str | bytes, str]]]
+
+# Where the offline messages are kept until they are uploaded. Rows go in as
+# (ts in epoch milliseconds, ip, response text or compressed BLOB, method) and come back from
+# claim as (id, ts, ip, response, method). Within a lane ids grow while it holds rows, but
+# once its newest rows are gone an id may be handed out again (SQLite continues after the
+# largest id left). Claimed rows are leased to one batch until they are acknowledged or the
+# batch is released
+class Storage(ABC):
+    @abstractmethod
+    async def open(self) -> None: ...
+
+    @abstractmethod
+    async def close(self) -> None: ...
+
+    @abstractmethod
+    async def append(self, rows: list[tuple[int, str, str | bytes, str]], lane: int = LANE_POINTS) -> None: ...
+
+    @abstractmethod
+    async def claim(self, batch_id: int, limit: int) -> list[tuple]: ...
+
+    @abstractmethod
+    async def ack(self, ids: list[int]) -> None: ...
+
+    @abstractmethod
+    async def release(self, batch_id: int) -> None: ...
+
+    @abstractmethod
+    async def release_all(self) -> None: ...
+
+    @abstractmethod
+    async def clear(self) -> None: ...
+
+    @abstractmethod
+    async def pending(self) -> dict[int, tuple[int, int, int] | None]:
+        # lane -> (first id, last id, bytes) of its stored rows, None for an empty lane
+        ...
+
+    @abstractmethod
+    async def read_before(self, lane: int, keep_from: int) -> list[tuple]:
+        # The rows of lane below keep_from, as claim returns them
+        ...
+
+    @abstractmethod
+    async def drop_before(self, lane: int, keep_from: int, rollups: list[tuple[int, str, str | bytes, str]] | None = None) -> None:
+        # Drops the rows of lane below keep_from and adds rollups to the rollup lane in the same step
+        ...
+
+    async def enforce_retention(self, max_rows: int, trim_rows: int, max_bytes: int, compact: Compactor | None = None) -> int:
+        # Lanes are trimmed in TRIM_ORDER, each only once the ones before it are empty. With
+        # compact, trimmed point value rows are replaced by the rollup rows it makes from them.
+        # Returns how many rollup rows were written
+        written = 0
+        pending = await self.pending()
+        if all(usage is None for usage in pending.values()):
+            logging.debug(f"No offline messages, skipping trim")
+            return written
+
+        for lane in TRIM_ORDER:
+            if pending[lane] is None:
+                continue
+            first_id, last_id, used_bytes = pending[lane]
+            other_rows = sum(usage[1] - usage[0] + 1 for other, usage in pending.items() if other != lane and usage is not None)
+            other_bytes = sum(usage[2] for other, usage in pending.items() if other != lane and usage is not None)
+            logging.debug(f"Offline messages in lane {lane}: at most {last_id - first_id + 1} rows in {used_bytes / 1_000_000:.1f} MB")
+
+            lane_max_bytes = max(max_bytes - other_bytes, 1) if max_bytes > 0 else 0
+            keep_from = retention_start(first_id, last_id, used_bytes, max(max_rows - other_rows, 0), trim_rows, lane_max_bytes)
+            if keep_from == first_id:
+                continue
+            rollups = None
+            if compact is not None and lane == LANE_POINTS:
+                trimmed = await self.read_before(lane, keep_from)
+                rollups = await asyncio.to_thread(compact, trimmed)
+                written += len(rollups)
+                logging.info(f"Rolled {len(trimmed)} trimmed messages up into {len(rollups)} messages")
+            await self.drop_before(lane, keep_from, rollups)
+            pending = await self.pending()
+            if pending[lane] is not None:
+                break
+        return written
+
+def retention_start(first_id: int, last_id: int, used_bytes: int, max_rows: int, trim_rows: int, max_bytes: int) -> int:
+    # Oldest id to keep, trimming trim_rows below the quota so it is not hit again right away
+    span = last_id - first_id + 1
+    keep_from = first_id
+    if span > max_rows:
+        keep_from = last_id - max(max_rows - trim_rows, 0) + 1
+        logging.info(f"Offline messages (up to {span}) exceeded maximum of {max_rows}, trimming {keep_from - first_id} messages")
+    if max_bytes > 0 and used_bytes > max_bytes:
+        bytes_per_row = used_bytes / span
+        excess_rows = int((used_bytes - max_bytes) / bytes_per_row) + trim_rows
+        keep_from = max(keep_from, first_id + excess_rows)
+        logging.info(f"Offline messages use {used_bytes / 1_000_000:.1f} MB, more than {max_bytes / 1_000_000:.1f} MB, trimming about {excess_rows} messages")
+    return keep_from
@@ -0,0 +1,40 @@
+import zlib
+
+# Payloads can be stored as BLOBs: one format byte followed by raw deflate data compressed
+# against a preset dictionary. The format byte names the dictionary, so a dictionary is never
+# changed once released, a new one gets a new format byte and old rows stay readable
+FORMAT_DEFLATE_DICT_1 = 1
+
+# Fragments that recur in stored E3 responses, most frequent last since deflate finds
+# matches near the end of the dictionary with the shortest distances
+_DICTIONARY_1_FRAGMENTS = (
+    '"DevAddr": "', '"Route": "', '"devicetype": "', '"commissionable": ', '"device": false, ',
+    '"categorydef": "', '"categoryname": "', '"category": "', '"appstatus": "', '"appname": "',
+    '{"jsonrpc": "2.0", "result": {"aps": [', '"apptype": "', '"iid": "', '"name": "',
+    '"error": "Could not complete request"}', '{"method": "', '"ip": "',
+    '{"jsonrpc": "2.0", "result": {"points": [', '{"ptr": "', '", "val": "', '"}, ',
+    "AppLongName", "AlarmOut", "CommStatus", "ControlType", "ActiveSetpt", "OccState",
+    "OutdoorTemp", "EngUnits", "EmergencyOvr", "AlgStatus", "UpdtRate", "UpdtPri", "ZoneHumidity",
+    "SupplyTemp", "MixedAirTemp", "OutdoorHumid", "HeatStage1", "HeatStage2", "CoolStage1",
+    "CoolStage2", "ZoneTemp", "FanProof", "SpaceTemp", "SuctionPresIn", "DevAddr", "FanStatus",
+    "ReturnTemp", "Occupancy", "ControlTemp", "Output", "Enable", "KWLoad", "AppName", "Alarm",
+    '"NONE"', "null", "true", "false",
+    '",0],["', '",1],["', '",null,1],["', '",0,0],["', '",1,0],["', '",0.0,0],["', '","', '[["',
+)
+PRESET_DICTIONARY_1 = "".join(_DICTIONARY_1_FRAGMENTS).encode()
+
+DICTIONARIES: dict[int, bytes] = {FORMAT_DEFLATE_DICT_1: PRESET_DICTIONARY_1}
+
+def compress_payload(text: str, level: int = 6) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=PRESET_DICTIONARY_1)
+    return bytes((FORMAT_DEFLATE_DICT_1,)) + compressor.compress(text.encode()) + compressor.flush()
+
+def decompress_payload(payload: str | bytes) -> str:
+    # Rows written without compression come back as text and pass through unchanged
+    if isinstance(payload, str):
+        return payload
+    dictionary = DICTIONARIES.get(payload[0])
+    if dictionary is None:
+        raise ValueError(f"Unknown payload format {payload[0]}")
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=dictionary)
+    return (decompressor.decompress(payload[1:]) + decompressor.flush()).decode()
@@ -1,75 +1,283 @@
-import aiosqlite
 import asyncio
 import json
-from datetime import datetime, timezone
+import zlib
+from functools import partial
+from time import monotonic, time
 import logging
 from pathlib import Path
 
-DATABASE_PATH = Path(__file__).parent.parent.parent / "data" / "database.db"
+import bms
+from .Storage import LANE_ALARMS, LANE_INVENTORY, LANE_NAMES, LANE_POINTS, LANE_ROLLUP, LANES, Storage
+from .SqliteStorage import SqliteStorage
+from .SegmentLogStorage import SegmentLogStorage
+from .compression import compress_payload, decompress_payload
+from .rollup import ROLLUP_METHOD, rollup_point_records
+
+DATA_PATH = Path(__file__).parent.parent.parent / "data"
+DATABASE_PATH = DATA_PATH / "database.db"
+SEGMENT_LOG_PATH = DATA_PATH / "outbox"
+POINT_VALUES_METHOD = "PointValues"
+
+# Outbox lane of each method, everything else goes with the point values
+METHOD_LANES = {
+    "GetAlarms": LANE_ALARMS,
+    "GetSystemInventory": LANE_INVENTORY,
+    ROLLUP_METHOD: LANE_ROLLUP,
+}
+
+_storage: Storage | None = None
+
+# Write-behind buffer, see start_write_buffer
+_write_queue: asyncio.Queue | None = None
+_flush_needed: asyncio.Event | None = None
+_flush_rows: int = 500
+# Rows a flush could not write, they are written ahead of the buffer on the next flush
+_unwritten: list[tuple[int, str, str | bytes, str]] = []
+
+# Batch ids handed out by claim_batch
+_last_batch_id: int = 0
+
+# Store new payloads as compressed BLOBs, see set_payload_compression
+_compress_payloads: bool = False
+
+# How long rows of each lane may wait for an upload, see set_lane_latency. Lanes with a
+# target of 0 are written and sent as soon as they are saved
+_lane_latency: dict[int, float] = {lane: 0.0 if lane == LANE_ALARMS else 10.0 for lane in LANES}
+# lane -> monotonic time its oldest row not yet handed to the uplink was written
+_pending_since: dict[int, float] = {}
+_send_needed: asyncio.Event | None = None
+
+def create_storage(settings_general) -> Storage:
+    backend = settings_general["storage_backend"]
+    if backend == "segment_log":
+        return SegmentLogStorage(SEGMENT_LOG_PATH, int(settings_general["segment_size_mb"] * 1_000_000))
+    if backend != "sqlite":
+        logging.warning(f"Unknown storage_backend {backend}, using sqlite")
+    return SqliteStorage(DATABASE_PATH)
+
+async def open_database(storage: Storage | None = None):
+    # One storage for the whole app, SQLite unless another backend is passed in
+    global _storage
+    if _storage is not None:
+        return
+    _storage = storage if storage is not None else SqliteStorage(DATABASE_PATH)
+    await _storage.open()
+    await release_all_batches()
+    # Anything left from the last run is sent as if it had just been written
+    for lane in LANES:
+        mark_pending(lane)
+
+async def close_database():
+    global _storage, _write_queue, _unwritten
+    await flush_writes()
+    if _unwritten:
+        logging.error(f"Could not write {len(_unwritten)} buffered messages to the database before closing it")
+    _write_queue = None
+    _unwritten = []
+    if _storage is None:
+        return
+    await _storage.close()
+    _storage = None
+
+async def storage() -> Storage:
+    if _storage is None:
+        await open_database()
+    return _storage
+
+def set_payload_compression(enabled: bool):
+    # Only affects rows saved from now on, stored text and BLOB rows can be mixed freely
+    global _compress_payloads
+    _compress_payloads = enabled
+
+def encode_payload(text: str) -> str | bytes:
+    return compress_payload(text) if _compress_payloads else text
 
 async def save_messages(data, ip, method):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        for message in data:
-            await db.execute(
-            f"""
-            INSERT INTO messages 
-            VALUES ("{datetime.now(timezone.utc).isoformat()}", "{ip}", '{json.dumps(message)}', "{method}", 0)
-            """
-            )
-        await db.commit()
-
-async def clear_messages(processed_only: bool = False):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        if processed_only:
-            await db.execute(f"""DELETE FROM messages WHERE processed = 1""")
-            logging.debug(f"Clearing local database of all processed messages")
-        else:
-            await db.execute(f"""DELETE FROM messages""")
-            logging.info(f"Clearing local database of all messages")
-        await db.commit()
-
-        await db.execute(f"""VACUUM""")
-        await db.commit()
-
-async def remove_bottom_n_records(n: int, max_n: int):
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        async with db.execute(f"SELECT COUNT(*) FROM messages") as cursor:
-            count = await cursor.fetchone()
-        logging.debug(f"Count of offline messages: {count[0]}")
-        if count[0] > max_n:
-            logging.info(f"Offline messages ({count[0]}) exceeded maximum of {max_n}, trimming {n} messages")
-            async with db.execute(f"""
-                DELETE FROM messages
-                WHERE rowid IN (
-                    SELECT rowid FROM messages
-                    ORDER BY timestamp DESC
-                    LIMIT -1 OFFSET (SELECT COUNT(*) FROM messages) - {n}
-                )
-            """) as _:
-                await db.commit()
-
-            async with db.execute(f"""VACUUM""") as _:
-                await db.commit()
-            logging.debug(f"Trimmed {n} offline messages")
-        else:
-            logging.debug(f"Offline messages count under max limit, skipping trim")
-
-async def load_and_set_rows():
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-
-        logging.debug("Loading queued messages into memory")
-        async with db.execute(f"SELECT * FROM messages WHERE processed = 0") as cursor:
-            rows = await cursor.fetchall()
-            
-        await db.execute(f"UPDATE messages SET processed = 1")
-        
-        await db.commit()
-        return rows
-
-async def unset_rows():
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        logging.debug("Unsetting the processed rows")
-        async with db.execute("UPDATE messages SET processed = 0") as _:
-            await db.commit()
-        logging.debug("Unset the processed messages")
+    ts = epoch_ms(time())
+    await enqueue_rows([(ts, ip, encode_payload(json.dumps(message)), method) for message in data])
+
+async def save_records(records: list[bms.PointRecord], ip: str, ts: float):
+    # All records of one poll go into a single compact row
+    await enqueue_rows([(epoch_ms(ts), ip, encode_payload(bms.encode_point_records(records)), POINT_VALUES_METHOD)])
+
+def epoch_ms(ts: float) -> int:
+    return int(ts * 1000)
+
+def lane_of(method: str) -> int:
+    return METHOD_LANES.get(method, LANE_POINTS)
+
+async def enqueue_rows(rows: list[tuple[int, str, str | bytes, str]]):
+    # Rows are written by the writer task, pollers only wait here when the buffer is full
+    if _write_queue is None:
+        await write_rows(rows)
+        return
+    for row in rows:
+        if _write_queue.full():
+            _flush_needed.set()
+        await _write_queue.put(row)
+    if _write_queue.qsize() >= _flush_rows or any(_lane_latency.get(lane_of(row[3]), 0) <= 0 for row in rows):
+        _flush_needed.set()
+
+async def write_rows(rows: list[tuple[int, str, str | bytes, str]]):
+    # rows are (ts in epoch milliseconds, ip, response text or compressed BLOB, method)
+    for lane, lane_rows in group_by_lane(rows).items():
+        await write_lane(lane_rows, lane)
+
+async def write_lane(rows: list[tuple[int, str, str | bytes, str]], lane: int):
+    await (await storage()).append(rows, lane)
+    mark_pending(lane)
+
+def group_by_lane(rows: list[tuple[int, str, str | bytes, str]]) -> dict[int, list]:
+    lanes: dict[int, list] = {}
+    for row in rows:
+        lanes.setdefault(lane_of(row[3]), []).append(row)
+    return lanes
+
+def set_lane_latency(latencies: dict[str, float]):
+    # latencies maps lane names (alarms, inventory, points, rollups) to seconds
+    global _send_needed
+    _send_needed = asyncio.Event()
+    for name, latency in latencies.items():
+        if name not in LANE_NAMES:
+            logging.warning(f"Unknown outbox lane {name}")
+            continue
+        _lane_latency[LANE_NAMES[name]] = latency
+
+def mark_pending(lane: int):
+    # A lane that starts waiting may be due before the uploader would wake up, so it is woken to
+    # work out its wait again
+    newly_pending = lane not in _pending_since
+    _pending_since.setdefault(lane, monotonic())
+    if _send_needed is not None and (newly_pending or _lane_latency.get(lane, 0) <= 0):
+        _send_needed.set()
+
+def send_due_in() -> float | None:
+    # Seconds until the first lane with waiting rows reaches its latency target, None if none has any
+    if not _pending_since:
+        return None
+    return min(since + _lane_latency.get(lane, 0) for lane, since in _pending_since.items()) - monotonic()
+
+async def wait_for_send(idle_wait: float):
+    # Returns when a lane is due for an upload, at the latest after idle_wait seconds when no
+    # lane has rows waiting. mark_pending wakes it whenever the first due lane may have changed
+    deadline = monotonic() + idle_wait
+    while True:
+        due = send_due_in()
+        timeout = deadline - monotonic() if due is None else due
+        if timeout <= 0:
+            return
+        if _send_needed is None:
+            await asyncio.sleep(timeout)
+            return
+        _send_needed.clear()
+        try:
+            await asyncio.wait_for(_send_needed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return
+
+def start_write_buffer(max_rows: int, flush_rows: int):
+    global _write_queue, _flush_needed, _flush_rows
+    _write_queue = asyncio.Queue(maxsize=max_rows)
+    _flush_needed = asyncio.Event()
+    _flush_rows = min(flush_rows, max_rows)
+
+async def run_writer(flush_interval: float):
+    # Flushes the buffer every flush_interval seconds, or sooner once flush_rows are waiting
+    while True:
+        try:
+            await asyncio.wait_for(_flush_needed.wait(), flush_interval)
+        except asyncio.TimeoutError:
+            pass
+        _flush_needed.clear()
+        await flush_writes()
+
+async def flush_writes():
+    # Lanes that fail to write are kept for the next flush, lanes already written are not
+    # written twice. The buffer stays full meanwhile, so pollers wait instead of piling up rows
+    global _unwritten
+    if _write_queue is None:
+        return
+    while _unwritten or not _write_queue.empty():
+        rows = _unwritten
+        _unwritten = []
+        while not _write_queue.empty() and len(rows) < _flush_rows:
+            rows.append(_write_queue.get_nowait())
+        lanes = group_by_lane(rows)
+        for lane in list(lanes):
+            try:
+                await write_lane(lanes[lane], lane)
+            except asyncio.CancelledError:
+                # Stopping, close_database writes what is left
+                _unwritten += [row for lane_rows in lanes.values() for row in lane_rows]
+                raise
+            except Exception as e:
+                logging.error(f"Could not write {len(lanes[lane])} buffered messages to the database, retrying on the next flush: {e}")
+                _unwritten += lanes[lane]
+            del lanes[lane]
+        if _unwritten:
+            return
+        logging.debug(f"Wrote {len(rows)} buffered messages to the database")
+
+async def clear_messages():
+    logging.info(f"Clearing local database of all messages")
+    await (await storage()).clear()
+
+async def enforce_retention(max_rows: int, trim_rows: int, max_bytes: int, rollup_window_s: float = 0):
+    # With a rollup window, point values that are trimmed are kept as per-window aggregates
+    compact = partial(rollup_rows, window_ms=int(rollup_window_s * 1000)) if rollup_window_s > 0 else None
+    if await (await storage()).enforce_retention(max_rows, trim_rows, max_bytes, compact):
+        mark_pending(LANE_ROLLUP)
+
+def rollup_rows(rows: list[tuple], window_ms: int) -> list[tuple[int, str, str | bytes, str]]:
+    # Rolls the point value rows among rows up, anything else is dropped with them
+    polls = []
+    decoded, _ = decode_rows([row for row in rows if row[4] == POINT_VALUES_METHOD])
+    for _, ts, ip, response, _ in decoded:
+        try:
+            polls.append((ts, ip, bms.decode_point_records(ip, ts, response)))
+        except (ValueError, TypeError) as e:
+            logging.debug(f"Could not roll up point values from {ip}: {e}")
+    return [(start, ip, encode_payload(text), ROLLUP_METHOD) for start, ip, text in rollup_point_records(polls, window_ms)]
+
+async def claim_batch(limit: int) -> tuple[int, list[tuple]]:
+    # Leases up to limit of the oldest unsent rows to a new batch,
+    # rows come back as (id, ts, ip, response, method) with compressed responses expanded
+    global _last_batch_id
+    _last_batch_id += 1
+    batch_id = _last_batch_id
+    rows = await (await storage()).claim(batch_id, limit)
+    if not rows:
+        # Every lane has been drained
+        _pending_since.clear()
+    # Payloads are only decompressed here, right before they are uploaded
+    rows, unreadable = decode_rows(rows)
+    if unreadable:
+        logging.error(f"Dropping {len(unreadable)} offline messages that could not be decompressed")
+        await (await storage()).ack(unreadable)
+    logging.debug(f"Claimed {len(rows)} messages in batch {batch_id}")
+    return batch_id, rows
+
+def decode_rows(rows: list[tuple]) -> tuple[list[tuple], list[int]]:
+    # Returns the rows with text payloads and the ids of rows whose payload is corrupt
+    decoded = []
+    unreadable = []
+    for row_id, ts, ip, response, method in rows:
+        try:
+            decoded.append((row_id, ts, ip, decompress_payload(response), method))
+        except (zlib.error, ValueError, IndexError) as e:
+            logging.debug(f"Could not decompress message {row_id}: {e}")
+            unreadable.append(row_id)
+    return decoded, unreadable
+
+async def ack_rows(ids: list[int]):
+    # Only rows that were actually delivered are removed
+    await (await storage()).ack(ids)
+    logging.debug(f"Acknowledged {len(ids)} sent messages")
+
+async def release_batch(batch_id: int):
+    await (await storage()).release(batch_id)
+    logging.debug(f"Released batch {batch_id} for a later retry")
 
+async def release_all_batches():
+    # Leases from a previous run can never be acknowledged
+    await (await storage()).release_all()
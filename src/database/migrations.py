@@ -0,0 +1,109 @@
+import logging
+
+import aiosqlite
+
+# Schema versions of the local database, tracked in PRAGMA user_version.
+# Each migration runs in its own transaction unless it is marked as not transactional
+# (VACUUM cannot run inside one), databases are upgraded in place on startup
+MIGRATIONS: list[tuple[int, str, str] | tuple[int, str, str, bool]] = [
+    (
+        1,
+        "messages table",
+        """
+        CREATE TABLE IF NOT EXISTS messages
+        (timestamp text, ip text, response text, method text, processed integer);
+        """,
+    ),
+    (
+        2,
+        "integer primary key, epoch timestamps and outbox indexes",
+        """
+        CREATE TABLE messages_v2 (
+            id INTEGER PRIMARY KEY,
+            ts INTEGER NOT NULL,
+            ip TEXT NOT NULL,
+            response TEXT NOT NULL,
+            method TEXT NOT NULL,
+            processed INTEGER NOT NULL DEFAULT 0
+        );
+        INSERT INTO messages_v2 (ts, ip, response, method)
+            SELECT
+                COALESCE(
+                    CAST(ROUND((julianday(timestamp) - 2440587.5) * 86400000) AS INTEGER),
+                    CAST(strftime('%s', 'now') AS INTEGER) * 1000
+                ),
+                COALESCE(ip, ''), COALESCE(response, ''), COALESCE(method, '')
+            FROM messages
+            ORDER BY rowid;
+        DROP TABLE messages;
+        ALTER TABLE messages_v2 RENAME TO messages;
+        CREATE INDEX idx_messages_outbox ON messages (processed, id);
+        CREATE INDEX idx_messages_ts ON messages (ts);
+        """,
+    ),
+    (
+        3,
+        "incremental auto vacuum",
+        """
+        PRAGMA auto_vacuum = INCREMENTAL;
+        VACUUM;
+        """,
+        False,
+    ),
+    (
+        4,
+        "outbox lanes, raw point values are sent before rollups",
+        """
+        ALTER TABLE messages ADD COLUMN lane INTEGER NOT NULL DEFAULT 0;
+        DROP INDEX idx_messages_outbox;
+        CREATE INDEX idx_messages_outbox ON messages (processed, lane, id);
+        """,
+    ),
+    (
+        5,
+        "priority lanes for alarms and inventories",
+        """
+        UPDATE messages SET lane = CASE method WHEN 'GetAlarms' THEN 2 WHEN 'GetSystemInventory' THEN 3 ELSE lane END
+            WHERE lane = 0;
+        """,
+    ),
+    (
+        6,
+        "an id range per lane",
+        """
+        UPDATE messages SET id = id + (lane << 48) WHERE lane > 0;
+        """,
+    ),
+    (
+        7,
+        "drop the unused timestamp index",
+        """
+        DROP INDEX IF EXISTS idx_messages_ts;
+        """,
+    ),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+async def migrate(db: aiosqlite.Connection):
+    async with db.execute("PRAGMA user_version") as cursor:
+        (version,) = await cursor.fetchone()
+    if version > SCHEMA_VERSION:
+        logging.warning(f"Database schema version {version} is newer than this app ({SCHEMA_VERSION})")
+        return
+
+    for target, description, script, *options in MIGRATIONS:
+        if target <= version:
+            continue
+        transactional = options[0] if options else True
+        logging.info(f"Migrating database to schema version {target}: {description}")
+        try:
+            if transactional:
+                await db.executescript(f"BEGIN;\n{script}\nPRAGMA user_version = {target};\nCOMMIT;")
+            else:
+                await db.executescript(f"{script}\nPRAGMA user_version = {target};")
+        except Exception:
+            await db.rollback()
+            logging.error(f"Database migration to schema version {target} failed")
+            raise
+        version = target
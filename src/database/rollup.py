@@ -0,0 +1,52 @@
+import json
+
+import bms
+
+ROLLUP_METHOD = "PointRollups"
+
+# Aggregate of one point over one window. Numeric values get min, max and avg,
+# every point keeps its last value and quality and the number of samples
+class PointAggregate:
+    __slots__ = ("minimum", "maximum", "total", "numeric", "last", "quality", "samples")
+
+    def __init__(self):
+        self.minimum: float | None = None
+        self.maximum: float | None = None
+        self.total: float = 0.0
+        self.numeric: int = 0
+        self.last = None
+        self.quality: int = 0
+        self.samples: int = 0
+
+    def add(self, record: bms.PointRecord) -> None:
+        value = record.value
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            self.minimum = value if self.minimum is None else min(self.minimum, value)
+            self.maximum = value if self.maximum is None else max(self.maximum, value)
+            self.total += value
+            self.numeric += 1
+        self.last = value
+        self.quality = record.quality
+        self.samples += 1
+
+    def encode(self, iid: str, point: str) -> list:
+        average = self.total / self.numeric if self.numeric else None
+        return [iid, point, self.minimum, self.maximum, average, self.last, self.quality, self.samples]
+
+def rollup_point_records(polls: list[tuple[int, str, list[bms.PointRecord]]], window_ms: int) -> list[tuple[int, str, str]]:
+    # polls are (ts in epoch milliseconds, ip, records) in the order they were saved. Returns one
+    # (window start, ip, encoded aggregates) row per controller and window, each aggregate is
+    # [iid, point, min, max, avg, last, quality, samples]
+    windows: dict[tuple[int, str], dict[tuple[str, str], PointAggregate]] = {}
+    for ts, ip, records in polls:
+        window = windows.setdefault((ts - ts % window_ms, ip), {})
+        for record in records:
+            aggregate = window.get((record.iid, record.point))
+            if aggregate is None:
+                aggregate = window[(record.iid, record.point)] = PointAggregate()
+            aggregate.add(record)
+
+    return [
+        (start, ip, json.dumps([aggregate.encode(iid, point) for (iid, point), aggregate in window.items()], separators=(",", ":")))
+        for (start, ip), window in sorted(windows.items())
+    ]
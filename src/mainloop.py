@@ -1,10 +1,12 @@
 import logging
 import asyncio
-from time import perf_counter
-# import random
+import random
+from time import monotonic, perf_counter
 from datetime import datetime
+from functools import partial
 
 import bms
+import scheduling
 import azure_connection
 import database
 
@@ -14,6 +16,11 @@ async def mainloop(settings_emerson3, settings_general, settings_azure, gui):
     # Initialize the controller and iot_device
     controllers = load_controllers(settings_emerson3, settings_general)
     iot_device = azure_connection.create_iot_device(settings_azure)
+    await asyncio.gather(*[controller.open() for controller in controllers])
+    await database.open_database(database.create_storage(settings_general))
+    database.set_payload_compression(settings_general["compress_offline_messages"])
+    database.set_lane_latency(settings_general["lane_latency_s"])
+    database.start_write_buffer(settings_general["write_buffer_rows"], settings_general["write_flush_rows"])
 
     # Add scheduled tasks
     tasks.append(refresh_inventories(controllers))
@@ -22,16 +29,25 @@ async def mainloop(settings_emerson3, settings_general, settings_azure, gui):
     tasks.append(poll_controllers(controllers, settings_emerson3, settings_general))
     tasks.append(poll_controller_inventories(controllers))
     tasks.append(poll_controllers_alarms(controllers))
+    tasks.append(watch_point_library(controllers))
+    tasks.append(database.run_writer(settings_general["write_flush_interval_s"]))
     tasks.append(send_to_iothub(settings_general, iot_device))
     tasks.append(maintain_database(settings_general))
     tasks.append(iot_connection_status_checker(iot_device, gui))
     tasks.append(update_gui(gui, controllers))
     # tasks.append(joke())
 
-    await asyncio.gather(*tasks)
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        await asyncio.gather(*[controller.close() for controller in controllers])
+        await database.close_database()
 
 def load_controllers(settings_emerson3, settings_general) -> list[bms.E3Interface]:
     interfaces: list[bms.E3Interface] = []
+    library = bms.get_point_library()
+    logging.info(f"Loaded point library with {len(library)} apptypes")
+    chunk_sizes = bms.load_chunk_sizes()
     for device in settings_emerson3["devices"]:
         interfaces.append(bms.E3Interface(
             name=device["name"],
@@ -40,77 +56,139 @@ def load_controllers(settings_emerson3, settings_general) -> list[bms.E3Interfac
             retries=settings_general["http_retries"],
             retry_delay=settings_general["retry_delay_ms"],
             request_delay=settings_general["request_delay_ms"],
+            pool_size=settings_general["http_pool_size"],
+            keepalive=settings_general["http_keepalive"],
+            max_in_flight=settings_general["max_requests_in_flight"],
+            max_request_rate=settings_general["max_request_rate"],
+            target_latency=settings_general["target_latency_ms"],
+            min_points=settings_general["min_points_per_request"],
+            max_points=settings_general["max_points_per_request"],
+            chunk_size=chunk_sizes.get(device["ip"], 50),
+            failure_threshold=settings_general["breaker_failure_threshold"],
+            max_backoff=settings_general["breaker_max_backoff_s"],
+            inventory_ttl=settings_general["inventory_cache_ttl_s"],
+            sid_ttl=settings_general["sid_cache_ttl_s"],
         ))
     return interfaces
 
 async def refresh_inventories(controllers: list[bms.E3Interface]):
-    while True:
-        logging.info(f"Refreshing controller inventories")
-        await asyncio.sleep(60*60*4)
-        tasks = [controller.set_system_inventory() for controller in controllers]
-        await asyncio.gather(*tasks)
+    async def refresh_inventory(controller):
+        if not await controller.available():
+            return
+        logging.info(f"Refreshing {controller.name}'s inventory")
+        await controller.set_system_inventory()
+
+    jobs = [(f"{controller.name} inventory refresh", partial(refresh_inventory, controller)) for controller in controllers]
+    await scheduling.run_staggered(jobs, 60*60*4, initial_delay=60*60*4)
 
 async def refresh_sessionid(controllers: list[bms.E3Interface]):
-    while True:
-        logging.info(f"Refreshing SessionIDs")
-        tasks = [controller.set_sid() for controller in controllers]
-        tasks.append(asyncio.sleep(60*60))
-        await asyncio.gather(*tasks)
+    async def refresh_controller_sessionid(controller):
+        if not await controller.available():
+            return
+        logging.info(f"Refreshing {controller.name}'s SessionID")
+        await controller.set_sid()
+
+    jobs = [(f"{controller.name} SessionID refresh", partial(refresh_controller_sessionid, controller)) for controller in controllers]
+    await scheduling.run_staggered(jobs, 60*60)
 
 async def touch_session(controllers: list[bms.E3Interface]):
+    async def touch_controller_session(controller):
+        if not await controller.available():
+            return
+        logging.debug(f"Touching {controller.name}'s http session")
+        await controller.touch_session()
+
+    jobs = [(f"{controller.name} session touch", partial(touch_controller_session, controller)) for controller in controllers]
+    await scheduling.run_staggered(jobs, 60*2, initial_delay=60*2)
+
+async def watch_point_library(controllers: list[bms.E3Interface]):
     while True:
-        await asyncio.sleep(60*2)
-        tasks = [controller.touch_session() for controller in controllers]
-        logging.info(f"Touching client http sessions")
-        await asyncio.gather(*tasks)
+        await asyncio.sleep(60)
+        if bms.reload_point_library():
+            for controller in controllers:
+                controller.apply_point_library()
 
 async def poll_controllers(controllers: list[bms.E3Interface], settings_emerson3, settings_general):
-    async def poll_controller(controller):
-        if controller.inventory == []:
-            await controller.set_system_inventory()
-        logging.info(f"{controller.name} started polling loop")
-        start = perf_counter()
-        for app in controller.inventory:
-            response = await controller.get_point_values(app)
-            await database.save_messages(response, controller.ip, "GetPointValues")
-            await asyncio.sleep(settings_general["request_delay_ms"]/1000)
-        end = perf_counter()
-        logging.info(f"{controller.name} finished polling loop in {(end-start):.2f} seconds")
+    polling_interval = settings_emerson3["polling_interval"]
+    tiers = scheduling.load_tiers(settings_emerson3["polling_tiers"], polling_interval)
+    change_filter = bms.ChangeFilter(settings_emerson3["deadbands"], settings_emerson3["heartbeat_interval"])
 
-    while True:
-        tasks = [poll_controller(controller) for controller in controllers]
-        tasks.append(asyncio.sleep(settings_emerson3["polling_interval"]))
-        await asyncio.gather(*tasks)
+    async def poll_controller(controller, offset):
+        queue = scheduling.PollQueue(controller.name, tiers, polling_interval, offset)
+        while True:
+            if controller.inventory == [] and await controller.available():
+                await controller.set_system_inventory()
+            queue.update(controller.inventory)
+            if len(queue) == 0:
+                await asyncio.sleep(polling_interval)
+                continue
+
+            items = await queue.next_due()
+            if not await controller.available():
+                logging.info(f"Skipping {len(items)} point groups of {controller.name}, circuit is {controller.breaker.state.value}")
+                queue.reschedule(items)
+                continue
+            logging.info(f"{controller.name} started polling {len(items)} point groups")
+            start = perf_counter()
+            records, errors = await controller.get_point_records([item.app for item in items])
+            changed = change_filter.filter(records, {item.app.iid: item.app.apptype for item in items})
+            if changed:
+                await database.save_records(changed, controller.ip, changed[0].ts)
+            if errors:
+                await database.save_messages(errors, controller.ip, "GetPointValues")
+            end = perf_counter()
+            logging.info(f"{controller.name} finished polling {len(items)} point groups in {(end-start):.2f} seconds")
+            queue.reschedule(items)
+
+            if controller.chunk_tuner.changed:
+                logging.info(f"{controller.name} now requests {controller.chunk_tuner.size} points per GetPointValues call")
+                save_learned_chunk_sizes()
+
+    def save_learned_chunk_sizes():
+        bms.save_chunk_sizes({controller.ip: controller.chunk_tuner.size for controller in controllers})
+        for controller in controllers:
+            controller.chunk_tuner.changed = False
+
+    # Spread the first poll of each controller across one polling interval
+    tasks = [
+        poll_controller(controller, i * polling_interval / len(controllers))
+        for i, controller in enumerate(controllers)
+    ]
+    await asyncio.gather(*tasks)
 
 async def poll_controller_inventories(controllers: list[bms.E3Interface]):
     async def poll_controller_inventory(controller):
+        if not await controller.available():
+            logging.info(f"Skipping {controller.name}'s inventory upload, circuit is {controller.breaker.state.value}")
+            return
         response = await controller.get_system_inventory()
         logging.info(f"Saving {controller.name}'s inventory data")
         await database.save_messages(response, controller.ip, "GetSystemInventory")
 
-    while True:
-        tasks = [poll_controller_inventory(controller) for controller in controllers]
-        tasks.append(asyncio.sleep(3600*2))
-        await asyncio.gather(*tasks)
+    jobs = [(f"{controller.name} inventory upload", partial(poll_controller_inventory, controller)) for controller in controllers]
+    await scheduling.run_staggered(jobs, 3600*2)
 
 async def poll_controllers_alarms(controllers: list[bms.E3Interface]):
     async def poll_controller_alarms(controller):
+        if not await controller.available():
+            logging.info(f"Skipping {controller.name}'s alarms upload, circuit is {controller.breaker.state.value}")
+            return
         response = await controller.get_alarms()
         logging.info(f"Saving {controller.name}'s alarms data")
         await database.save_messages(response, controller.ip, "GetAlarms")
 
-    while True:
-        tasks = [poll_controller_alarms(controller) for controller in controllers]
-        tasks.append(asyncio.sleep(3600))
-        await asyncio.gather(*tasks)
+    jobs = [(f"{controller.name} alarms upload", partial(poll_controller_alarms, controller)) for controller in controllers]
+    await scheduling.run_staggered(jobs, 3600)
 
 async def maintain_database(settings_general):
     while True:
         tasks = []
 
-        tasks.append(database.remove_bottom_n_records(
+        tasks.append(database.enforce_retention(
+            settings_general["max_offline_messages"],
             settings_general["offline_message_trimsize"],
-            settings_general["max_offline_messages"]
+            settings_general["max_offline_mb"] * 1_000_000,
+            settings_general["rollup_window_s"] if settings_general["rollup_enabled"] else 0,
         ))
 
         tasks.append(asyncio.sleep(60))
@@ -118,36 +196,55 @@ async def maintain_database(settings_general):
         await asyncio.gather(*tasks)
 
 async def send_to_iothub(settings_general, iot_device):
-    async def logic():
+    # Sends that failed are retried after a growing delay, starting at publish_interval
+    failures = 0
+    retry_at = 0.0
 
+    async def logic():
+        nonlocal failures, retry_at
+        if not iot_device.connected:
+            await iot_device.provision_device()
         if not iot_device.connected:
-            iot_device.provision_device()
+            return
 
-        # Get rows from messages table
-        rows = await database.load_and_set_rows()
+        # Stream the outbox in bounded batches until it is empty or a send fails, every batch
+        # starts with the highest priority lane so new alarms never wait behind a backlog
+        sent = 0
+        while True:
+            batch_id, rows = await database.claim_batch(settings_general["outbox_batch_rows"])
+            if len(rows) == 0:
+                break
 
-        # Try to send to IoTHub
-        if (num_messages:=len(rows) > 0) and (iot_device.connected):
-            logging.debug("Attempting to send messages to IoTHub")
-            successful_send = await iot_device.send_messages(rows)
-            logging.info("Sent messages to IoTHub")
-        elif num_messages == 0:
-            logging.info("No messages to send")
-            successful_send = False
-        else:
-            successful_send = False
+            logging.debug(f"Attempting to send {len(rows)} messages to IoTHub")
+            delivered, undelivered = await iot_device.send_messages(rows)
+            if delivered:
+                await database.ack_rows(delivered)
+                sent += len(delivered)
+            if undelivered:
+                # Only the rows that did not arrive go back to the outbox
+                await database.release_batch(batch_id)
+                failures += 1
+                delay = min(settings_general["send_max_backoff_s"], settings_general["publish_interval"] * 2 ** (failures - 1))
+                delay *= random.uniform(0.5, 1.5)
+                retry_at = monotonic() + delay
+                logging.warning(f"{len(undelivered)} messages were not delivered to IoTHub, retrying in {delay:.0f} seconds")
+                break
+            failures = 0
 
-        if successful_send:
-            await database.clear_messages(processed_only=True)
+        if sent > 0:
+            logging.info(f"Sent {sent} messages to IoTHub")
         else:
-            await database.unset_rows()
+            logging.info("No messages to send")
 
+    # Sends as soon as a lane reaches its latency target, or right away for alarms
     while True:
-        tasks = [
-            logic(),
-            asyncio.sleep(settings_general["publish_interval"]),
-        ]
-        await asyncio.gather(*tasks)
+        await logic()
+        if monotonic() < retry_at:
+            await asyncio.sleep(retry_at - monotonic())
+        elif not iot_device.connected:
+            await asyncio.sleep(settings_general["publish_interval"])
+        else:
+            await database.wait_for_send(settings_general["publish_interval"])
 
 async def iot_connection_status_checker(iot_device, gui):
     await asyncio.sleep(10)
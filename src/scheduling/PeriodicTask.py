@@ -0,0 +1,50 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+# Runs a coroutine function on a fixed-rate timeline. Run times are computed from the
+# start of the timeline so they do not drift, and a run that takes longer than the
+# interval skips the slots it missed instead of queueing them up
+class PeriodicTask:
+    def __init__(self, name: str, func: Callable[[], Awaitable], interval: float, offset: float = 0.0):
+        self.name: str = name
+        self.func: Callable[[], Awaitable] = func
+        self.interval: float = interval
+        self.offset: float = offset
+        self.runs: int = 0
+        self.overruns: int = 0
+        self.skipped: int = 0
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        next_run = loop.time() + self.offset
+        while True:
+            delay = next_run - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            try:
+                await self.func()
+            except Exception as e:
+                logging.error(f"{self.name} failed: {e}")
+            self.runs += 1
+
+            next_run += self.interval
+            finished = loop.time()
+            if finished > next_run:
+                missed = int((finished - next_run) // self.interval) + 1
+                self.overruns += 1
+                self.skipped += missed
+                logging.warning(
+                    f"{self.name} overran its {self.interval}s period by {finished - next_run:.1f}s, "
+                    f"skipping {missed} run(s) ({self.overruns} overruns so far)"
+                )
+                next_run += missed * self.interval
+
+async def run_staggered(jobs: list[tuple[str, Callable[[], Awaitable]]], interval: float, initial_delay: float = 0.0):
+    # Each job gets its own timeline, start offsets are spread evenly across one interval
+    tasks = [
+        PeriodicTask(name, func, interval, initial_delay + i * interval / len(jobs))
+        for i, (name, func) in enumerate(jobs)
+    ]
+    await asyncio.gather(*[task.run() for task in tasks])
@@ -0,0 +1,95 @@
+import asyncio
+import dataclasses
+import heapq
+import logging
+from itertools import count
+
+DEFAULT_PRIORITY = 5
+
+@dataclasses.dataclass(frozen=True)
+class PollTier:
+    interval: float
+    priority: int = DEFAULT_PRIORITY
+
+def load_tiers(tiers_config: dict[str, dict], default_interval: float) -> dict[str, PollTier]:
+    # Keys are an apptype ("Global Data") or a single point of an apptype ("Enhanced Suction:SuctPress")
+    return {
+        key: PollTier(
+            interval=tier.get("interval", default_interval),
+            priority=tier.get("priority", DEFAULT_PRIORITY),
+        )
+        for key, tier in tiers_config.items()
+    }
+
+# One group of points of one application that share a polling tier
+class PollItem:
+    __slots__ = ("app", "tier", "due")
+
+    def __init__(self, app, tier: PollTier, due: float):
+        self.app = app
+        self.tier: PollTier = tier
+        self.due: float = due
+
+# Priority queue of the point groups of one controller, ordered by due time and then priority.
+# Every group keeps its own fixed-rate timeline, groups that overrun skip their missed slots
+class PollQueue:
+    def __init__(self, name: str, tiers: dict[str, PollTier], default_interval: float, offset: float = 0.0):
+        self.name: str = name
+        self.tiers: dict[str, PollTier] = tiers
+        self.default_tier: PollTier = PollTier(default_interval)
+        self.offset: float = offset
+        self.inventory: list | None = None
+        self.skipped: int = 0
+        self._heap: list[tuple[float, int, int, PollItem]] = []
+        self._counter = count()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def tier_for(self, apptype: str, point: str) -> PollTier:
+        return self.tiers.get(f"{apptype}:{point}") or self.tiers.get(apptype) or self.default_tier
+
+    def update(self, inventory: list) -> None:
+        # Regroup when the controller's inventory changes, groups that still exist keep their due time
+        if inventory is self.inventory:
+            return
+        now = asyncio.get_running_loop().time()
+        due_times = {(item.app.iid, item.app.properties): item.due for _, _, _, item in self._heap}
+        self._heap = []
+        for app in inventory:
+            groups: dict[PollTier, list[str]] = {}
+            for point in app.properties:
+                groups.setdefault(self.tier_for(app.apptype, point), []).append(point)
+            for tier, points in groups.items():
+                properties = app.properties if len(groups) == 1 else tuple(points)
+                due = due_times.get((app.iid, properties), now + self.offset)
+                self._push(PollItem(dataclasses.replace(app, properties=properties), tier, due))
+        self.inventory = inventory
+        logging.debug(f"{self.name} polls {len(self._heap)} point groups")
+
+    async def next_due(self) -> list[PollItem]:
+        # Wait for the earliest group, then take every group that is due, most important first
+        loop = asyncio.get_running_loop()
+        delay = self._heap[0][0] - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        now = loop.time()
+        items = []
+        while self._heap and self._heap[0][0] <= now:
+            items.append(heapq.heappop(self._heap)[3])
+        items.sort(key=lambda item: item.tier.priority)
+        return items
+
+    def reschedule(self, items: list[PollItem]) -> None:
+        now = asyncio.get_running_loop().time()
+        for item in items:
+            item.due += item.tier.interval
+            if item.due <= now:
+                missed = int((now - item.due) // item.tier.interval) + 1
+                self.skipped += missed
+                logging.warning(f"{self.name} overran the {item.tier.interval}s period of {item.app.appname}, skipping {missed} run(s)")
+                item.due += missed * item.tier.interval
+            self._push(item)
+
+    def _push(self, item: PollItem) -> None:
+        heapq.heappush(self._heap, (item.due, item.tier.priority, next(self._counter), item))
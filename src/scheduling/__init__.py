@@ -0,0 +1,2 @@
+from .PeriodicTask import PeriodicTask, run_staggered
+from .PollQueue import PollQueue, PollTier, load_tiers
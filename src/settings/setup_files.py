@@ -1,7 +1,6 @@
 import os
 import json
 import logging
-import sqlite3
 from typing import Any
 from pathlib import Path
 
@@ -17,6 +16,8 @@ SETTINGS_AZURE = {
     "certificate_name": "",
     "keyvault": "",
     "sas_ttl": 90,
+    "payload_format": 1,
+    "max_concurrent_sends": 4,
 }
 
 SETTINGS_GENERAL = {
@@ -24,17 +25,43 @@ SETTINGS_GENERAL = {
     "logfile_maxsize_mb": 100,
     "max_offline_messages": 1_000,
     "offline_message_trimsize": 250,
+    "max_offline_mb": 500,
+    "rollup_enabled": False,
+    "rollup_window_s": 900,
+    "compress_offline_messages": False,
+    "storage_backend": "sqlite",
+    "segment_size_mb": 4,
+    "write_buffer_rows": 10_000,
+    "write_flush_rows": 500,
+    "write_flush_interval_s": 2,
     "http_retries": 3,
     "retry_delay_ms": 3_000,
     "http_timeout": 3,
+    "http_pool_size": 2,
+    "http_keepalive": 30,
     "request_delay_ms": 1_000,
+    "max_requests_in_flight": 2,
+    "max_request_rate": 20,
+    "target_latency_ms": 1_000,
+    "min_points_per_request": 10,
+    "max_points_per_request": 150,
+    "breaker_failure_threshold": 3,
+    "breaker_max_backoff_s": 900,
+    "inventory_cache_ttl_s": 300,
+    "sid_cache_ttl_s": 60,
     "publish_interval": 10,
+    "lane_latency_s": {"alarms": 0, "inventory": 10, "points": 10, "rollups": 60},
+    "outbox_batch_rows": 1_000,
+    "send_max_backoff_s": 600,
     "workers": 2,
     "gui": False,
 }
 
 SETTINGS_EMERSON3 = {
     "polling_interval": 180,
+    "polling_tiers": {},
+    "deadbands": {},
+    "heartbeat_interval": 3600,
     "devices": [
         {
             "name": "panel_0",
@@ -82,16 +109,7 @@ def create_files():
     create_conf("settings_emerson3.json", SETTINGS_EMERSON3)
     create_conf("ptrs.json", PTRS)
 
-    # Create database file
-    with sqlite3.connect(RUNTIME_DIRS[1]/"database.db") as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS messages
-            (timestamp text, ip text, response text, method text, processed integer)
-            """
-        )
-        conn.commit()
+    # The database file and its schema are created by database.open_database
 
     # Create jsonl log file
     logfile_path = RUNTIME_DIRS[2]/"log.jsonl"
@@ -109,6 +127,11 @@ def load_files():
         if this_conf.keys() == conf_structure.keys():
             logger.debug(f"Loaded {file} successfully")
             return this_conf
+        if this_conf.keys() < conf_structure.keys():
+            # Older conf files are missing settings added in later versions
+            missing = [key for key in conf_structure if key not in this_conf]
+            logger.info(f"Using default values for new settings in {file}: {missing}")
+            return {**conf_structure, **this_conf}
         logger.warning(f"Incorrect structure detected at {file}. Please verify")
         logger.warning(f"Continuing with default definition for {file}")
         return conf_structure
@@ -0,0 +1,19 @@
+import asyncio
+
+from bms.Application import Application
+from bms.E3Interface import E3Interface
+
+def test_open_circuit_saves_nothing():
+    async def body():
+        controller = E3Interface("panel_0", "192.0.2.1", timeout=1, retries=3, retry_delay=1_000, request_delay=0, failure_threshold=1)
+        controller.sid = "sid"
+        controller.breaker.record_failure()
+        assert not controller.breaker.closed
+        apps = [Application("Suction 1", "Enhanced Suction", "1", properties=("SuctionPres", "SuctionTemp"))]
+        try:
+            records, errors = await controller.get_point_records(apps)
+        finally:
+            await controller.close()
+        assert records == []
+        assert errors == []
+    asyncio.run(body())
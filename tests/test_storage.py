@@ -0,0 +1,197 @@
+import asyncio
+
+import pytest
+
+from database.SegmentLogStorage import SegmentLogStorage
+from database.SqliteStorage import SqliteStorage
+from database.Storage import LANE_ALARMS, LANE_INVENTORY
+
+BACKENDS = {
+    "sqlite": lambda path: SqliteStorage(path / "e3_data.db"),
+    "segment_log": lambda path: SegmentLogStorage(path / "outbox", 64_000),
+}
+
+# Runs a test body against a fresh storage of each backend, reopen gives a new instance on
+# the same files
+@pytest.fixture(params=BACKENDS)
+def backend(request, tmp_path):
+    return lambda: BACKENDS[request.param](tmp_path)
+
+def run(body):
+    return asyncio.run(body())
+
+def points(count: int, size: int = 10, start: int = 0) -> list[tuple]:
+    return [(start + i, "10.0.0.1", f'{{"value": "{"x" * size}"}}', "GetPointValues") for i in range(count)]
+
+async def claim_all(storage) -> list[tuple]:
+    rows = await storage.claim(999, 1_000_000)
+    await storage.release(999)
+    return rows
+
+def test_append_and_claim(backend):
+    async def body():
+        storage = backend()
+        await storage.open()
+        await storage.append(points(3))
+        rows = await storage.claim(1, 10)
+        assert [tuple(row[1:]) for row in rows] == points(3)
+        assert [row[0] for row in rows] == sorted(row[0] for row in rows)
+        assert await storage.claim(2, 10) == []
+        await storage.close()
+    run(body)
+
+def test_claim_limit_and_lane_priority(backend):
+    async def body():
+        storage = backend()
+        await storage.open()
+        await storage.append(points(5))
+        await storage.append([(10, "10.0.0.1", "{}", "GetSystemInventory")], LANE_INVENTORY)
+        await storage.append([(20, "10.0.0.1", "{}", "GetAlarms")], LANE_ALARMS)
+        rows = await storage.claim(1, 3)
+        assert [row[4] for row in rows] == ["GetAlarms", "GetSystemInventory", "GetPointValues"]
+        assert len(await storage.claim(2, 10)) == 4
+        await storage.close()
+    run(body)
+
+def test_ack_removes_rows(backend):
+    async def body():
+        storage = backend()
+        await storage.open()
+        await storage.append(points(4))
+        rows = await storage.claim(1, 10)
+        # Out of order, the way concurrent sends finish
+        await storage.ack([rows[2][0], rows[0][0]])
+        await storage.release(1)
+        assert [row[1] for row in await claim_all(storage)] == [1, 3]
+        await storage.close()
+    run(body)
+
+def test_release_returns_rows(backend):
+    async def body():
+        storage = backend()
+        await storage.open()
+        await storage.append(points(4))
+        first = await storage.claim(1, 2)
+        second = await storage.claim(2, 10)
+        assert {row[0] for row in first}.isdisjoint(row[0] for row in second)
+        await storage.release(1)
+        assert [row[0] for row in await storage.claim(3, 10)] == [row[0] for row in first]
+        await storage.release_all()
+        assert len(await storage.claim(4, 10)) == 4
+        await storage.close()
+    run(body)
+
+def test_reopen_keeps_undelivered_rows(backend):
+    async def body():
+        storage = backend()
+        await storage.open()
+        await storage.append(points(5))
+        rows = await storage.claim(1, 2)
+        await storage.ack([rows[0][0]])
+        await storage.close()
+
+        storage = backend()
+        await storage.open()
+        # A batch leased before the restart was never confirmed
+        await storage.release_all()
+        assert [row[1] for row in await claim_all(storage)] == [1, 2, 3, 4]
+        await storage.append(points(1, start=5))
+        assert [row[1] for row in await claim_all(storage)] == [1, 2, 3, 4, 5]
+        await storage.close()
+    run(body)
+
+def test_retention_by_rows(backend):
+    async def body():
+        storage = backend()
+        await storage.open()
+        await storage.append(points(200))
+        await storage.enforce_retention(100, 10, 0)
+        assert [row[1] for row in await claim_all(storage)] == list(range(110, 200))
+        await storage.enforce_retention(100, 10, 0)
+        assert len(await claim_all(storage)) == 90
+        await storage.close()
+    run(body)
+
+def test_retention_by_bytes(backend):
+    async def body():
+        storage = backend()
+        await storage.open()
+        await storage.append(points(1_000, size=1_000))
+        await storage.enforce_retention(1_000_000, 0, 300_000)
+        kept = [row[1] for row in await claim_all(storage)]
+        assert 0 < len(kept) <= 300
+        assert kept == list(range(1_000 - len(kept), 1_000))
+        await storage.close()
+    run(body)
+
+def test_retention_trims_points_before_alarms(backend):
+    async def body():
+        storage = backend()
+        await storage.open()
+        for i in range(2_000):
+            if i % 500 == 0:
+                await storage.append([(i, "10.0.0.1", "{}", "GetAlarms")], LANE_ALARMS)
+            else:
+                await storage.append(points(1, start=i))
+        await storage.enforce_retention(1_000, 100, 0)
+        rows = await claim_all(storage)
+        assert len(rows) == 900
+        assert [row[1] for row in rows if row[4] == "GetAlarms"] == [0, 500, 1_000, 1_500]
+        await storage.close()
+    run(body)
+
+def test_retention_under_limits_and_clear(backend):
+    async def body():
+        storage = backend()
+        await storage.open()
+        await storage.append(points(10))
+        assert await storage.enforce_retention(100, 10, 0, compact=lambda rows: rows) == 0
+        assert len(await claim_all(storage)) == 10
+        await storage.clear()
+        assert await claim_all(storage) == []
+        await storage.close()
+    run(body)
+
+def test_torn_tail_is_discarded(tmp_path):
+    async def body():
+        storage = BACKENDS["segment_log"](tmp_path)
+        await storage.open()
+        await storage.append(points(3))
+        await storage.close()
+
+        # A crash in the middle of writing the last record
+        segment = max((tmp_path / "outbox").glob("*.seg"))
+        with open(segment, "r+b") as file:
+            file.truncate(segment.stat().st_size - 5)
+
+        storage = BACKENDS["segment_log"](tmp_path)
+        await storage.open()
+        assert [row[1] for row in await claim_all(storage)] == [0, 1]
+        await storage.append(points(1, start=3))
+        assert [row[1] for row in await claim_all(storage)] == [0, 1, 3]
+        await storage.close()
+
+        storage = BACKENDS["segment_log"](tmp_path)
+        await storage.open()
+        assert [row[1] for row in await claim_all(storage)] == [0, 1, 3]
+        await storage.close()
+    run(body)
+
+def test_corrupt_record_is_discarded(tmp_path):
+    async def body():
+        storage = BACKENDS["segment_log"](tmp_path)
+        await storage.open()
+        await storage.append(points(3))
+        await storage.close()
+
+        # Bits flipped in the payload of the last record fail its checksum
+        segment = max((tmp_path / "outbox").glob("*.seg"))
+        data = bytearray(segment.read_bytes())
+        data[-3] ^= 0xFF
+        segment.write_bytes(bytes(data))
+
+        storage = BACKENDS["segment_log"](tmp_path)
+        await storage.open()
+        assert [row[1] for row in await claim_all(storage)] == [0, 1]
+        await storage.close()
+    run(body)